@@ -1,19 +1,32 @@
 import argparse
-import json
+import asyncio
+import contextlib
+import fnmatch
+import functools
+import gzip
+import hashlib
 import os
+import shutil
 import subprocess
 import sys
-from typing import Any, List, Literal, Optional
+import time
+import zlib
+from collections import OrderedDict
+from typing import Annotated, Any, AsyncGenerator, List, Literal, NamedTuple, Optional
 
+import orjson
 from mcp.server.fastmcp import FastMCP
 from pydantic import Field
 
-# Global variable for config path (will be set by parse_args_and_get_config)
+# Global variables for config path and result cache directory (will be set by parse_args_and_get_config)
 CONFIG_PATH = None
+CACHE_DIR = None
+# Arguments passing the config to ast-grep, built once instead of on every call
+CONFIG_ARGS: tuple[str, ...] = ()
 
 def parse_args_and_get_config():
-    """Parse command-line arguments and determine config path."""
-    global CONFIG_PATH
+    """Parse command-line arguments and determine config path and cache directory."""
+    global CONFIG_PATH, CACHE_DIR, CONFIG_ARGS, RESULT_CACHE_SIZE
 
     # Determine how the script was invoked
     prog = None
@@ -28,6 +41,7 @@ def parse_args_and_get_config():
         epilog='''
 environment variables:
   AST_GREP_CONFIG    Path to sgconfig.yaml file (overridden by --config flag)
+  AST_GREP_CACHE_DIR Directory for persisting search results (overridden by --cache-dir flag)
 
 For more information, see: https://github.com/ast-grep/ast-grep-mcp
         ''',
@@ -39,31 +53,65 @@ For more information, see: https://github.com/ast-grep/ast-grep-mcp
         metavar='PATH',
         help='Path to sgconfig.yaml file for customizing ast-grep behavior (language mappings, rule directories, etc.)'
     )
+    parser.add_argument(
+        '--cache-dir',
+        type=str,
+        nargs='?',
+        const=default_cache_dir(),
+        metavar='PATH',
+        help='Directory for persisting search results across sessions (disabled by default). '
+             'Without PATH, $XDG_CACHE_HOME/ast-grep-mcp is used'
+    )
+    parser.add_argument(
+        '--cache-size',
+        type=int,
+        default=RESULT_CACHE_SIZE,
+        metavar='N',
+        help=f'Number of recent tool results kept in memory for reuse, 0 disables it (default: {RESULT_CACHE_SIZE})'
+    )
     args = parser.parse_args()
+    if args.cache_size < 0:
+        parser.error('--cache-size must not be negative')
+    RESULT_CACHE_SIZE = args.cache_size
 
     # Determine config path with precedence: --config flag > AST_GREP_CONFIG env > None
+    # Errors go to stderr: stdout carries the MCP protocol once the stdio transport runs
     if args.config:
-        if not os.path.exists(args.config):
-            print(f"Error: Config file '{args.config}' does not exist")
-            sys.exit(1)
+        if not os.path.isfile(args.config):
+            sys.exit(f"Error: Config file '{args.config}' does not exist or is not a file")
         CONFIG_PATH = args.config
-    elif os.environ.get('AST_GREP_CONFIG'):
-        env_config = os.environ.get('AST_GREP_CONFIG')
-        if env_config and not os.path.exists(env_config):
-            print(f"Error: Config file '{env_config}' specified in AST_GREP_CONFIG does not exist")
-            sys.exit(1)
+    elif env_config := os.environ.get('AST_GREP_CONFIG'):
+        if not os.path.isfile(env_config):
+            sys.exit(f"Error: Config file '{env_config}' specified in AST_GREP_CONFIG does not exist or is not a file")
         CONFIG_PATH = env_config
+    if CONFIG_PATH:
+        CONFIG_ARGS = ("--config", CONFIG_PATH)
+
+    # Determine cache directory with precedence: --cache-dir flag > AST_GREP_CACHE_DIR env > None (disabled)
+    cache_dir = args.cache_dir or os.environ.get('AST_GREP_CACHE_DIR')
+    if cache_dir:
+        CACHE_DIR = os.path.expanduser(cache_dir)
+
+def default_cache_dir() -> str:
+    """Return the per-user cache directory following the XDG base directory spec."""
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(cache_home, 'ast-grep-mcp')
 
 # Initialize FastMCP server
-mcp = FastMCP("ast-grep")
+mcp = FastMCP(
+    "ast-grep",
+    instructions="Structural code search with ast-grep. When exploring a project with several patterns, "
+                 "call find_code_batch once instead of calling find_code for each pattern.",
+)
 
 DumpFormat = Literal["pattern", "cst", "ast"]
+OUTPUT_FORMATS = frozenset(("text", "json"))
 
 @mcp.tool()
-def dump_syntax_tree(
-    code: str = Field(description = "The code you need"),
-    language: str = Field(description = "The language of the code"),
-    format: DumpFormat = Field(description = "Code dump format. Available values: pattern, ast, cst", default = "cst"),
+async def dump_syntax_tree(
+    code: Annotated[str, Field(description = "The code you need")],
+    language: Annotated[str, Field(description = "The language of the code")],
+    format: Annotated[DumpFormat, Field(description = "Code dump format. Available values: pattern, ast, cst")] = "cst",
 ) -> str:
     """
     Dump code's syntax structure or dump a query's pattern structure.
@@ -73,42 +121,51 @@ def dump_syntax_tree(
     use `format=cst` to inspect the code's concrete syntax tree structure, useful to debug target code.
     use `format=pattern` to inspect how ast-grep interprets a pattern, useful to debug pattern rule.
 
-    Internally calls: ast-grep run --pattern <code> --lang <language> --debug-query=<format>
+    Internally calls: ast-grep run --pattern <code> --lang <language> --debug-query=<format> --stdin
     """
-    result = run_ast_grep("run", ["--pattern", code, "--lang", language, f"--debug-query={format}"])
-    return result.stderr.strip()  # type: ignore[no-any-return]
+    # Searching empty stdin, instead of the working directory, leaves ast-grep only the dump to do.
+    # The dump goes to stderr and finding nothing exits with 1, so that exit code is fine here.
+    result = await run_ast_grep(
+        "run",
+        ["--pattern", code, "--lang", language, f"--debug-query={format}", "--stdin"],
+        input_bytes=b"",
+        ok_returncodes=(0, 1),
+    )
+    return result.stderr.decode().strip()  # type: ignore[no-any-return]
 
 @mcp.tool()
-def test_match_code_rule(
-    code: str = Field(description="The code to test against the rule"),
-    yaml: str = Field(description="The ast-grep YAML rule to search. It must have id, language, rule fields."),
+async def test_match_code_rule(
+    code: Annotated[str, Field(description="The code to test against the rule")],
+    yaml: Annotated[str, Field(description="The ast-grep YAML rule to search. It must have id, language, rule fields.")],
 ) -> List[dict[str, Any]]:
     """
     Test a code against an ast-grep YAML rule.
     This is useful to test a rule before using it in a project.
 
-    Internally calls: ast-grep scan --inline-rules <yaml> --json --stdin
+    Internally calls: ast-grep scan --inline-rules <yaml> --json=compact --stdin
     """
-    result = run_ast_grep("scan", ["--inline-rules", yaml, "--json", "--stdin"], input_text = code)
-    matches = json.loads(result.stdout.strip())
+    result = await run_ast_grep("scan", ["--inline-rules", yaml, "--json=compact", "--stdin"], input_bytes = code.encode())
+    # Empty output means nothing matched too; it is not valid JSON, so check before parsing
+    matches = orjson.loads(result.stdout) if result.stdout and not result.stdout.isspace() else []
     if not matches:
         raise ValueError("No matches found for the given code and rule. Try adding `stopBy: end` to your inside/has rule.")
     return matches  # type: ignore[no-any-return]
 
 @mcp.tool()
-def find_code(
-    project_folder: str = Field(description="The absolute path to the project folder. It must be absolute path."),
-    pattern: str = Field(description="The ast-grep pattern to search for. Note, the pattern must have valid AST structure."),
-    language: str = Field(description="The language of the query", default=""),
-    max_results: Optional[int] = Field(default=None, description="Maximum results to return"),
-    output_format: str = Field(default="text", description="'text' or 'json'"),
+async def find_code(
+    project_folder: Annotated[str, Field(description="The absolute path to the project folder. It must be absolute path.")],
+    pattern: Annotated[str, Field(description="The ast-grep pattern to search for. Note, the pattern must have valid AST structure.")],
+    language: Annotated[str, Field(description="The language of the query")] = "",
+    max_results: Annotated[Optional[int], Field(description="Maximum results to return")] = None,
+    output_format: Annotated[str, Field(description="'text' or 'json'")] = "text",
 ) -> str | List[dict[str, Any]]:
     """
     Find code in a project folder that matches the given ast-grep pattern.
     Pattern is good for simple and single-AST node result.
     For more complex usage, please use YAML by `find_code_by_rule`.
+    To search for several patterns at once, prefer a single `find_code_batch` call over repeated `find_code` calls.
 
-    Internally calls: ast-grep run --pattern <pattern> [--json] <project_folder>
+    Internally calls: ast-grep run --pattern <pattern> --json=stream <project_folder>
 
     Output formats:
     - text (default): Compact text format with file:line-range headers and complete match text
@@ -127,44 +184,33 @@ def find_code(
     - json: Full match objects with metadata including ranges, meta-variables, etc.
 
     The max_results parameter limits the number of complete matches returned (not individual lines).
-    When limited, the header shows "Found X matches (showing first Y of Z)".
+    The search stops as soon as more than max_results matches are found, so when limited the header
+    shows "Found X matches (showing first X, more available)", or "(showing first X of Z)" if the
+    total is already known from an earlier search.
 
     Example usage:
       find_code(pattern="class $NAME", max_results=20)  # Returns text format
       find_code(pattern="class $NAME", output_format="json")  # Returns JSON with metadata
     """
-    if output_format not in ["text", "json"]:
+    if output_format not in OUTPUT_FORMATS:
         raise ValueError(f"Invalid output_format: {output_format}. Must be 'text' or 'json'.")
 
     args = ["--pattern", pattern]
     if language:
         args.extend(["--lang", language])
 
-    # Always get JSON internally for accurate match limiting
-    result = run_ast_grep("run", args + ["--json", project_folder])
-    matches = json.loads(result.stdout.strip() or "[]")
-
-    # Apply max_results limit to complete matches
-    total_matches = len(matches)
-    if max_results is not None and total_matches > max_results:
-        matches = matches[:max_results]
+    result = await search_project("run", args, project_folder, max_results)
 
     if output_format == "text":
-        if not matches:
-            return "No matches found"
-        text_output = format_matches_as_text(matches)
-        header = f"Found {len(matches)} matches"
-        if max_results is not None and total_matches > max_results:
-            header += f" (showing first {max_results} of {total_matches})"
-        return header + ":\n\n" + text_output
-    return matches  # type: ignore[no-any-return]
+        return format_search_result_as_text(result)
+    return result.matches
 
 @mcp.tool()
-def find_code_by_rule(
-    project_folder: str = Field(description="The absolute path to the project folder. It must be absolute path."),
-    yaml: str = Field(description="The ast-grep YAML rule to search. It must have id, language, rule fields."),
-    max_results: Optional[int] = Field(default=None, description="Maximum results to return"),
-    output_format: str = Field(default="text", description="'text' or 'json'"),
+async def find_code_by_rule(
+    project_folder: Annotated[str, Field(description="The absolute path to the project folder. It must be absolute path.")],
+    yaml: Annotated[str, Field(description="The ast-grep YAML rule to search. It must have id, language, rule fields.")],
+    max_results: Annotated[Optional[int], Field(description="Maximum results to return")] = None,
+    output_format: Annotated[str, Field(description="'text' or 'json'")] = "text",
     ) -> str | List[dict[str, Any]]:
     """
     Find code using ast-grep's YAML rule in a project folder.
@@ -173,7 +219,7 @@ def find_code_by_rule(
 
     Tip: When using relational rules (inside/has), add `stopBy: end` to ensure complete traversal.
 
-    Internally calls: ast-grep scan --inline-rules <yaml> [--json] <project_folder>
+    Internally calls: ast-grep scan --inline-rules <yaml> --json=stream <project_folder>
 
     Output formats:
     - text (default): Compact text format with file:line-range headers and complete match text
@@ -192,35 +238,130 @@ def find_code_by_rule(
     - json: Full match objects with metadata including ranges, meta-variables, etc.
 
     The max_results parameter limits the number of complete matches returned (not individual lines).
-    When limited, the header shows "Found X matches (showing first Y of Z)".
+    The search stops as soon as more than max_results matches are found, so when limited the header
+    shows "Found X matches (showing first X, more available)", or "(showing first X of Z)" if the
+    total is already known from an earlier search.
 
     Example usage:
       find_code_by_rule(yaml="id: x\\nlanguage: python\\nrule: {pattern: 'class $NAME'}", max_results=20)
       find_code_by_rule(yaml="...", output_format="json")  # For full metadata
     """
-    if output_format not in ["text", "json"]:
+    if output_format not in OUTPUT_FORMATS:
         raise ValueError(f"Invalid output_format: {output_format}. Must be 'text' or 'json'.")
 
     args = ["--inline-rules", yaml]
 
-    # Always get JSON internally for accurate match limiting
-    result = run_ast_grep("scan", args + ["--json", project_folder])
-    matches = json.loads(result.stdout.strip() or "[]")
+    result = await search_project("scan", args, project_folder, max_results)
+
+    if output_format == "text":
+        return format_search_result_as_text(result)
+    return result.matches
+
+@mcp.tool()
+async def find_code_batch(
+    project_folder: Annotated[str, Field(description="The absolute path to the project folder. It must be absolute path.")],
+    patterns: Annotated[List[str], Field(description="The ast-grep patterns to search for. Each pattern must have valid AST structure.")],
+    language: Annotated[str, Field(description="The language of the queries")] = "",
+    max_results: Annotated[Optional[int], Field(description="Maximum results to return per pattern")] = None,
+    output_format: Annotated[str, Field(description="'text' or 'json'")] = "text",
+) -> str | dict[str, List[dict[str, Any]]]:
+    """
+    Find code matching several ast-grep patterns in a project folder with a single tool call.
+    Batching patterns is faster than calling `find_code` once per pattern: with a language,
+    all patterns are matched in one pass over the project, otherwise the searches run concurrently.
+
+    Internally calls: ast-grep scan --inline-rules <one rule per pattern> --json=stream <project_folder>
+    or, without a language (or if ast-grep rejects a pattern as a rule),
+    ast-grep run --pattern <pattern> --json=stream --threads <n> <project_folder> per pattern
+
+    Output formats:
+    - text (default): One section per pattern, each in the same format as `find_code`
+      Example:
+        Pattern: class $NAME
+        Found 1 matches:
+
+        src/models.py:45-46
+        class UserModel:
+            pass
 
-    # Apply max_results limit to complete matches
-    total_matches = len(matches)
-    if max_results is not None and total_matches > max_results:
-        matches = matches[:max_results]
+        Pattern: def $NAME()
+        No matches found
+
+    - json: Object mapping each pattern to its list of full match objects
+
+    The max_results parameter applies to each pattern separately.
+
+    Example usage:
+      find_code_batch(patterns=["class $NAME", "def $NAME($$$)"], language="python")
+    """
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Invalid output_format: {output_format}. Must be 'text' or 'json'.")
+
+    results: Optional[List[SearchResult]] = None
+    if language and len(patterns) > 1:
+        try:
+            results = await search_patterns_in_one_scan(project_folder, patterns, language, max_results)
+        except RuntimeError:
+            # `scan` rejects some patterns that `run` accepts, e.g. incomplete nodes like "class $NAME"
+            pass
+
+    if results is None:
+        # Split the cores between the concurrent scans instead of letting each ast-grep use all of them
+        threads = max(1, (os.cpu_count() or 1) // max(1, len(patterns)))
+
+        async def search(pattern: str) -> SearchResult:
+            args = ["--pattern", pattern]
+            if language:
+                args.extend(["--lang", language])
+            return await search_project("run", args, project_folder, max_results, threads=threads)
+
+        results = await asyncio.gather(*(search(pattern) for pattern in patterns))
 
     if output_format == "text":
-        if not matches:
-            return "No matches found"
-        text_output = format_matches_as_text(matches)
-        header = f"Found {len(matches)} matches"
-        if max_results is not None and total_matches > max_results:
-            header += f" (showing first {max_results} of {total_matches})"
-        return header + ":\n\n" + text_output
-    return matches  # type: ignore[no-any-return]
+        return "\n\n".join(
+            f"Pattern: {pattern}\n{format_search_result_as_text(result)}"
+            for pattern, result in zip(patterns, results)
+        )
+    return {pattern: result.matches for pattern, result in zip(patterns, results)}
+
+# Fields `scan` adds to each match that `run --pattern` does not report
+SCAN_ONLY_FIELDS = ("ruleId", "severity", "note", "message", "labels")
+
+async def search_patterns_in_one_scan(
+    project_folder: str, patterns: List[str], language: str, max_results: Optional[int]
+) -> List["SearchResult"]:
+    """Match several patterns in a single ast-grep process, so each file is read and parsed only once.
+
+    Every pattern becomes one rule of a multi-document inline YAML; matches are grouped by rule id.
+    """
+    # JSON strings are valid YAML scalars, which quotes the patterns without a YAML library
+    quoted_language = orjson.dumps(language).decode()
+    rules = "\n---\n".join(
+        f"id: p{i}\nlanguage: {quoted_language}\nrule:\n  pattern: {orjson.dumps(pattern).decode()}"
+        for i, pattern in enumerate(patterns)
+    )
+    # All matches are needed to split them by pattern, so max_results cannot stop the scan early
+    found = await search_project("scan", ["--inline-rules", rules], project_folder)
+
+    grouped: List[List[dict[str, Any]]] = [[] for _ in patterns]
+    for match in found.matches:
+        index = int(match["ruleId"][1:])
+        for field in SCAN_ONLY_FIELDS:
+            match.pop(field, None)
+        grouped[index].append(match)
+    return [SearchResult(matches[:max_results], len(matches)) for matches in grouped]
+
+def format_search_result_as_text(result: "SearchResult") -> str:
+    """Format limited search results with a header stating how many matches were found."""
+    matches, total = result
+    if not matches:
+        return "No matches found"
+    header = f"Found {len(matches)} matches"
+    if total is None:
+        header += f" (showing first {len(matches)}, more available)"
+    elif total > len(matches):
+        header += f" (showing first {len(matches)} of {total})"
+    return header + ":\n\n" + format_matches_as_text(matches)
 
 def format_matches_as_text(matches: List[dict]) -> str:
     """Convert JSON matches to LLM-friendly text format.
@@ -233,10 +374,20 @@ def format_matches_as_text(matches: List[dict]) -> str:
 
     output_blocks = []
     for m in matches:
-        file_path = m.get('file', '')
-        start_line = m.get('range', {}).get('start', {}).get('line', 0) + 1
-        end_line = m.get('range', {}).get('end', {}).get('line', 0) + 1
-        match_text = m.get('text', '').rstrip()
+        # ast-grep always reports these fields, so index directly and only fall back
+        # to defaults for incomplete matches
+        try:
+            file_path = m['file']
+            match_range = m['range']
+            start_line = match_range['start']['line'] + 1
+            end_line = match_range['end']['line'] + 1
+            match_text = m['text'].rstrip()
+        except KeyError:
+            file_path = m.get('file', '')
+            match_range = m.get('range', {})
+            start_line = match_range.get('start', {}).get('line', 0) + 1
+            end_line = match_range.get('end', {}).get('line', 0) + 1
+            match_text = m.get('text', '').rstrip()
 
         # Format: filepath:start-end (or just :line for single-line matches)
         if start_line == end_line:
@@ -248,33 +399,538 @@ def format_matches_as_text(matches: List[dict]) -> str:
 
     return '\n\n'.join(output_blocks)
 
-def run_command(args: List[str], input_text: Optional[str] = None) -> subprocess.CompletedProcess:
+# Recent project search results, most recently used last
+RESULT_CACHE_SIZE = 32
+# Each entry holds the raw JSON line of every match and whether the matches are complete
+# or were cut short by max_results. Lines are far more compact than parsed dicts and
+# only the matches actually returned get parsed.
+_result_cache: OrderedDict[tuple, tuple[List[bytes], bool]] = OrderedDict()
+# Searches whose ast-grep process is still running, by cache key
+_inflight_scans: dict[tuple, asyncio.Task[tuple[List[bytes], bool]]] = {}
+# Files whose rules decide which entries ast-grep skips, so editing them changes the search results
+IGNORE_FILES = (".gitignore", ".ignore")
+# Kinds of ignore files, highest precedence first: like in ast-grep, a match in any .ignore file
+# beats a match in any .gitignore file, which beats one in .git/info/exclude
+IGNORE_KINDS = (".ignore", ".gitignore", "exclude")
+
+class IgnoreRule(NamedTuple):
+    """One pattern of an ignore file, split into path components."""
+    parts: List[str]
+    negated: bool
+    # Patterns containing a slash match paths relative to the ignore file's folder, others any entry name
+    anchored: bool
+
+class IgnoreRuleSet(NamedTuple):
+    """The rules of one ignore file."""
+    kind: str
+    # Path components leading from the ignore file's folder to the project folder, for files above the project
+    prefix: tuple[str, ...]
+    # Number of leading components of a project-relative path to drop, for files inside the project
+    depth: int
+    rules: List[IgnoreRule]
+
+def project_fingerprint(project_folder: str) -> Optional[str]:
+    """Cheaply fingerprint a project tree to tell whether cached search results are still valid.
+
+    Hashes the path, mtime and size of every entry, so editing, creating, deleting or
+    renaming anything changes the digest, even if a file gets an older mtime back
+    (e.g. from `git stash pop` or `rsync -t`). Only metadata is read, never file contents.
+    Folders ast-grep skips are not walked at all: folders the ignore files exclude
+    (e.g. node_modules/) and hidden folders no ignore rule re-includes. Files are always
+    hashed, hidden ones included, since ast-grep scans hidden files of the searched languages.
+    The ignore files above the tree are hashed too, since they decide what ast-grep scans.
+    Returns None if the folder cannot be walked.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    try:
+        digest.update(b"%d\n" % os.stat(project_folder).st_mtime_ns)
+        ignore_files, git_root, outer_rules = outer_ignore_files(project_folder)
+        # Whether .gitignore files apply depends on the repository the project belongs to
+        digest.update(b"%s\n" % os.fsencode(git_root or ""))
+        pending: List[tuple[str, tuple[str, ...], List[IgnoreRuleSet], bool]] = [
+            (project_folder, (), outer_rules, git_root is not None)
+        ]
+        while pending:
+            folder, parts, rule_sets, in_repo = pending.pop()
+            with os.scandir(folder) as scan:
+                entries = list(scan)
+            names = {entry.name for entry in entries}
+            if parts and ".git" in names:
+                # A nested repository: the .gitignore rules of the folders above stop applying to it
+                in_repo = True
+                rule_sets = [rule_set for rule_set in rule_sets if rule_set.kind == ".ignore"]
+                exclude = os.path.join(folder, ".git", "info", "exclude")
+                ignore_files.append(exclude)
+                rule_sets.append(IgnoreRuleSet("exclude", (), len(parts), read_ignore_rules(exclude)))
+            # The ignore files of a folder apply to its whole subtree
+            for name in IGNORE_FILES if in_repo else (".ignore",):
+                rules = read_ignore_rules(os.path.join(folder, name)) if name in names else []
+                if rules:
+                    rule_sets = [*rule_sets, IgnoreRuleSet(name, (), len(parts), rules)]
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    entry_parts = (*parts, entry.name)
+                    ignored = match_ignore_rules(rule_sets, entry_parts)
+                    if ignored or (ignored is None and entry.name.startswith(".")):
+                        continue
+                    pending.append((entry.path, entry_parts, rule_sets, in_repo))
+                stat = entry.stat(follow_symlinks=False)
+                digest.update(b"%s\0%d\0%d\n" % (os.fsencode(entry.path), stat.st_mtime_ns, stat.st_size))
+        for path in ignore_files:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            digest.update(b"%s\0%d\0%d\n" % (os.fsencode(path), stat.st_mtime_ns, stat.st_size))
+    except OSError:
+        return None
+    return digest.hexdigest()
+
+def outer_ignore_files(project_folder: str) -> tuple[List[str], Optional[str], List[IgnoreRuleSet]]:
+    """Find the ignore files outside a project folder that apply to it.
+
+    These are the .ignore files of all its parent folders and, inside a git repository, the
+    .gitignore files of its parent folders up to the repository root and the repository's
+    .git/info/exclude. Files that do not exist are included too, since creating one changes
+    what ast-grep skips.
+
+    Returns the ignore files, the repository root (None outside a repository) and the rules
+    of those files, outermost first.
+    """
+    # Each folder from the project up to the filesystem root, with the path leading back to the project
+    folder = os.path.abspath(project_folder)
+    folders: List[tuple[str, tuple[str, ...]]] = [(folder, ())]
+    while (parent := os.path.dirname(folder)) != folder:
+        folders.append((parent, (os.path.basename(folder), *folders[-1][1])))
+        folder = parent
+    # The innermost folder with a .git entry is the root of the repository the project belongs to
+    repo_index = next((i for i, (folder, _) in enumerate(folders) if os.path.exists(os.path.join(folder, ".git"))), None)
+    paths: List[str] = []
+    rule_sets: List[IgnoreRuleSet] = []
+    git_root = None
+    if repo_index is not None:
+        git_root, root_parts = folders[repo_index]
+        paths.append(os.path.join(git_root, ".git", "info", "exclude"))
+        rule_sets.append(IgnoreRuleSet("exclude", root_parts, 0, read_ignore_rules(paths[-1])))
+    # The project folder's own ignore files are read while walking it
+    for i in range(len(folders) - 1, 0, -1):
+        folder, folder_parts = folders[i]
+        for name in IGNORE_FILES if repo_index is not None and i <= repo_index else (".ignore",):
+            paths.append(os.path.join(folder, name))
+            rule_sets.append(IgnoreRuleSet(name, folder_parts, 0, read_ignore_rules(paths[-1])))
+    return paths, git_root, [rule_set for rule_set in rule_sets if rule_set.rules]
+
+def read_ignore_rules(path: str) -> List[IgnoreRule]:
+    """Parse a .gitignore-style file. A missing or unreadable file has no rules."""
     try:
-        # On Windows, if ast-grep is installed via npm, it's a batch file
-        # that requires shell=True to execute properly
-        use_shell = (sys.platform == "win32" and args[0] == "ast-grep")
-
-        result = subprocess.run(
-            args,
-            capture_output=True,
-            input=input_text,
-            text=True,
-            check=True,  # Raises CalledProcessError if return code is non-zero
-            shell=use_shell
+        with open(path, encoding="utf-8", errors="replace") as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return []
+    rules = []
+    for line in lines:
+        line = line.rstrip()
+        if not line or line.startswith("#"):
+            continue
+        negated = line.startswith("!")
+        if negated or line.startswith("\\"):
+            line = line[1:]
+        # A trailing slash restricts a pattern to folders, and only folders are matched against the rules
+        pattern = line.rstrip("/")
+        parts = [part for part in pattern.split("/") if part]
+        if parts:
+            rules.append(IgnoreRule(parts, negated, "/" in pattern))
+    return rules
+
+def match_ignore_rules(rule_sets: List[IgnoreRuleSet], parts: tuple[str, ...]) -> Optional[bool]:
+    """Tell whether the ignore rules exclude a folder (True), re-include it (False) or do not mention it (None).
+
+    parts is the folder's path relative to the project. Like in ast-grep, the deepest ignore file of
+    each kind with a matching rule decides for that kind, with its last matching rule winning,
+    and the kinds then take precedence in IGNORE_KINDS order.
+    """
+    decided: dict[str, bool] = {}
+    for rule_set in reversed(rule_sets):
+        if rule_set.kind in decided:
+            continue
+        path = (*rule_set.prefix, *parts[rule_set.depth:])
+        for rule in reversed(rule_set.rules):
+            if rule.anchored:
+                matched = match_ignore_pattern(rule.parts, path)
+            else:
+                matched = fnmatch.fnmatchcase(path[-1], rule.parts[0])
+            if matched:
+                decided[rule_set.kind] = not rule.negated
+                break
+    return next((decided[kind] for kind in IGNORE_KINDS if kind in decided), None)
+
+def match_ignore_pattern(pattern: List[str], path: tuple[str, ...]) -> bool:
+    """Match glob components against path components; `**` spans any number of folders."""
+    if not pattern:
+        return not path
+    if pattern[0] == "**":
+        return any(match_ignore_pattern(pattern[1:], path[i:]) for i in range(len(path) + 1))
+    return bool(path) and fnmatch.fnmatchcase(path[0], pattern[0]) and match_ignore_pattern(pattern[1:], path[1:])
+
+def config_mtime() -> Optional[int]:
+    """Return the config file's mtime for cache keys, so editing the config takes effect.
+
+    None without a config, or if the config cannot be read; ast-grep then reports the problem itself.
+    """
+    if not CONFIG_PATH:
+        return None
+    try:
+        return os.stat(CONFIG_PATH).st_mtime_ns
+    except OSError:
+        return None
+
+class SearchResult(NamedTuple):
+    """The matches returned by a project search, limited to max_results."""
+    matches: List[dict[str, Any]]
+    # Total number of matches, or None if the scan stopped early because more than max_results exist
+    total: Optional[int]
+
+async def search_project(
+    command: str,
+    args: List[str],
+    project_folder: str,
+    max_results: Optional[int] = None,
+    threads: Optional[int] = None,
+) -> SearchResult:
+    """Run an ast-grep search over a project folder.
+
+    Returns at most max_results matches and the total number of matches, or None for the total
+    if ast-grep was stopped early because more than max_results matches exist.
+    threads caps ast-grep's thread pool; it does not affect the results and is not part of the cache key.
+
+    Results are kept in a small LRU cache and reused while the project tree and the
+    config file are unchanged, since agents often repeat the same search.
+    Identical searches arriving while one is still running share its ast-grep process,
+    even with caching disabled.
+    """
+    # With both caches disabled no result could be reused, so the tree is not even fingerprinted
+    caching = RESULT_CACHE_SIZE > 0 or CACHE_DIR
+    fingerprint = await asyncio.to_thread(project_fingerprint, project_folder) if caching else None
+    key = (command, tuple(args), project_folder, CONFIG_PATH, config_mtime(), fingerprint)
+    # Only results of a fingerprinted tree are cached, but identical running searches are always shared
+    cache_key = key if fingerprint is not None else None
+    if cache_key is not None:
+        entry = _result_cache.get(cache_key)
+        if entry is not None:
+            _result_cache.move_to_end(cache_key)
+        elif CACHE_DIR:
+            entry = await asyncio.to_thread(load_cached_lines, cache_key)
+            if entry is not None:
+                remember_lines(cache_key, *entry)
+        if entry is not None and covers_limit(*entry, max_results):
+            return limit_matches(*entry, max_results)
+
+    scan = _inflight_scans.get(key)
+    if scan is None:
+        scan = asyncio.ensure_future(scan_project(command, args, project_folder, max_results, threads, cache_key))
+        _inflight_scans[key] = scan
+        scan.add_done_callback(functools.partial(forget_inflight_scan, key))
+    # Shielded so that a cancelled caller does not cancel the scan other callers are waiting for
+    entry = await asyncio.shield(scan)
+    if not covers_limit(*entry, max_results):
+        # The shared scan was stopped early for a lower max_results than this search needs
+        entry = await scan_project(command, args, project_folder, max_results, threads, cache_key)
+    return limit_matches(*entry, max_results)
+
+async def scan_project(
+    command: str,
+    args: List[str],
+    project_folder: str,
+    max_results: Optional[int],
+    threads: Optional[int],
+    key: Optional[tuple],
+) -> tuple[List[bytes], bool]:
+    """Run ast-grep over a project folder and cache the results under key, unless it is None.
+
+    Returns the JSON line of each match and whether the matches are complete.
+    """
+    # Always get JSON internally for accurate match limiting.
+    # Streamed JSON (one match per line) is collected while ast-grep is still scanning,
+    # without ever holding the whole output as one string.
+    lines: List[bytes] = []
+    complete = True
+    thread_args = ("--threads", str(threads)) if threads is not None else ()
+    scan_args = [*args, "--json=stream", *thread_args, project_folder]
+    async with contextlib.aclosing(stream_ast_grep(command, scan_args)) as stream:
+        async for line in stream:
+            lines.append(line)
+            if max_results is not None and len(lines) > max_results:
+                # One match past the limit proves there are more, so stop scanning the project here
+                complete = False
+                break
+
+    if key is not None:
+        remember_lines(key, lines, complete)
+        if CACHE_DIR:
+            await asyncio.to_thread(store_cached_lines, key, lines, complete)
+    return lines, complete
+
+def forget_inflight_scan(key: tuple, scan: asyncio.Task) -> None:
+    if _inflight_scans.get(key) is scan:
+        del _inflight_scans[key]
+    if not scan.cancelled():
+        # Mark a failure as retrieved; every waiting caller gets it re-raised from its own await
+        scan.exception()
+
+def covers_limit(lines: List[bytes], complete: bool, max_results: Optional[int]) -> bool:
+    """Whether (possibly partial) cached results are enough to answer a search limited to max_results."""
+    return complete or (max_results is not None and len(lines) > max_results)
+
+def limit_matches(
+    lines: List[bytes], complete: bool, max_results: Optional[int]
+) -> SearchResult:
+    """Parse the JSON lines of the first max_results matches."""
+    total = len(lines) if complete else None
+    if max_results is not None and len(lines) > max_results:
+        lines = lines[:max_results]
+    return SearchResult([orjson.loads(line) for line in lines], total)
+
+def remember_lines(key: tuple, lines: List[bytes], complete: bool) -> None:
+    """Add search results to the in-memory LRU cache, evicting the least recently used entry."""
+    _result_cache[key] = (lines, complete)
+    if len(_result_cache) > RESULT_CACHE_SIZE:
+        _result_cache.popitem(last=False)
+
+# Result files kept per project folder; older ones are deleted when new results are stored
+DISK_CACHE_ENTRIES_PER_PROJECT = 32
+# Seconds after which a temporary result file counts as abandoned by a crashed writer
+STALE_TMP_FILE_AGE = 3600
+
+@functools.lru_cache(maxsize=None)
+def ast_grep_version() -> str:
+    """Return the output of `ast-grep --version`, queried once per server process.
+
+    Blocks, so it is only called from worker threads. An ast-grep that cannot be started yields "".
+    """
+    try:
+        result = subprocess.run([resolve_executable("ast-grep"), "--version"], capture_output=True)
+    except OSError:
+        return ""
+    return result.stdout.decode(errors="replace").strip()
+
+def disk_cache_path(key: tuple) -> Optional[str]:
+    """Return the file persisting the results for a cache key, or None if the disk cache is disabled.
+
+    Each project folder (key[2]) gets its own subdirectory, so its entries can be pruned together.
+    The file name also covers the ast-grep version, since upgrading ast-grep can change the results.
+    """
+    if not CACHE_DIR:
+        return None
+    project_dir = hashlib.sha256(key[2].encode()).hexdigest()[:16]
+    name = hashlib.sha256(repr((ast_grep_version(), key)).encode()).hexdigest()
+    return os.path.join(CACHE_DIR, project_dir, name + ".ndjson.gz")
+
+def load_cached_lines(key: tuple) -> Optional[tuple[List[bytes], bool]]:
+    """Load persisted search results. Missing or unreadable entries count as a cache miss."""
+    path = disk_cache_path(key)
+    if path is None:
+        return None
+    try:
+        with gzip.open(path, "rb") as f:
+            header, *lines = f.read().splitlines(keepends=True)
+        entry = lines, orjson.loads(header)["complete"]
+    except (OSError, EOFError, zlib.error, ValueError, KeyError, TypeError):
+        return None
+    # Mark the entry as recently used so pruning keeps it
+    with contextlib.suppress(OSError):
+        os.utime(path)
+    return entry
+
+def store_cached_lines(key: tuple, lines: List[bytes], complete: bool) -> None:
+    """Persist search results as a header line followed by the JSON lines of the matches.
+    The disk cache is best-effort, so write errors are ignored.
+    """
+    path = disk_cache_path(key)
+    if path is None:
+        return
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with gzip.open(tmp_path, "wb", compresslevel=1) as f:
+            f.write(orjson.dumps({"complete": complete}) + b"\n")
+            f.writelines(lines)
+        # Rename into place so concurrent readers never see a partially written file
+        os.replace(tmp_path, path)
+        prune_disk_cache(path)
+    except OSError:
+        with contextlib.suppress(OSError):
+            os.remove(tmp_path)
+
+def prune_disk_cache(stored_path: str) -> None:
+    """Delete all but the most recently used result files of the project stored_path belongs to,
+    and temporary files abandoned by writers that crashed before renaming them into place.
+
+    Results for outdated fingerprints are never looked up again, so without pruning
+    every edit of the project would leave files behind.
+    """
+    files = []
+    stale_tmp_files = []
+    stale_before = time.time_ns() - STALE_TMP_FILE_AGE * 1_000_000_000
+    with os.scandir(os.path.dirname(stored_path)) as entries:
+        for entry in entries:
+            if entry.name.endswith(".tmp"):
+                # Left behind by a server process that died while writing; live writes take far less time
+                if entry.stat().st_mtime_ns < stale_before:
+                    stale_tmp_files.append(entry.path)
+            elif entry.name.endswith(".ndjson.gz") and entry.path != stored_path:
+                files.append((entry.stat().st_mtime_ns, entry.path))
+    files.sort(reverse=True)
+    # The file just stored counts as the most recently used one
+    for path in stale_tmp_files + [path for _, path in files[DISK_CACHE_ENTRIES_PER_PROJECT - 1:]]:
+        # Another server process may have pruned the same file already
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(path)
+
+# Bound concurrent ast-grep processes: each one already runs its own thread pool,
+# so running more of them than there are cores only oversubscribes the CPU.
+_SUBPROCESS_SEMAPHORE = asyncio.Semaphore(os.cpu_count() or 1)
+
+# asyncio's default 64 KiB line limit is too small for streamed JSON of large matches
+_STREAM_LINE_LIMIT = 64 * 1024 * 1024
+
+@functools.lru_cache(maxsize=None)
+def resolve_executable(name: str) -> str:
+    """Resolve a command name to its full path once, falling back to the bare name."""
+    return shutil.which(name) or name
+
+def runs_in_shell(executable: str) -> bool:
+    """Whether spawn_command starts an executable through cmd.exe."""
+    return sys.platform == "win32" and executable.lower().endswith((".cmd", ".bat"))
+
+async def spawn_command(args: List[str], stdin: int) -> asyncio.subprocess.Process:
+    """Start a command with piped stdout/stderr without blocking the event loop."""
+    # CPython only starts children via posix_spawn (vfork semantics, no page table copy)
+    # when the executable is given as a path and no preexec_fn, cwd, pass_fds,
+    # start_new_session or user/group change is requested. Keep it that way when
+    # adding arguments here, otherwise every call falls back to fork + exec.
+    executable = resolve_executable(args[0])
+    try:
+        if runs_in_shell(executable):
+            # On Windows, if ast-grep is installed via npm, it's a batch file
+            # that requires a shell to execute properly. An .exe (pip, cargo, scoop)
+            # is started directly, without paying for a cmd.exe process per call.
+            return await asyncio.create_subprocess_shell(
+                subprocess.list2cmdline(args),
+                stdin=stdin,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+                limit=_STREAM_LINE_LIMIT,
+            )
+        return await asyncio.create_subprocess_exec(
+            executable,
+            *args[1:],
+            stdin=stdin,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            limit=_STREAM_LINE_LIMIT,
         )
-        return result
-    except subprocess.CalledProcessError as e:
-        stderr_msg = e.stderr.strip() if e.stderr else "(no error output)"
-        error_msg = f"Command {e.cmd} failed with exit code {e.returncode}: {stderr_msg}"
-        raise RuntimeError(error_msg) from e
     except FileNotFoundError as e:
         error_msg = f"Command '{args[0]}' not found. Please ensure {args[0]} is installed and in PATH."
         raise RuntimeError(error_msg) from e
 
-def run_ast_grep(command:str, args: List[str], input_text: Optional[str] = None) -> subprocess.CompletedProcess:
-    if CONFIG_PATH:
-        args = ["--config", CONFIG_PATH] + args
-    return run_command(["ast-grep", command] + args, input_text)
+async def kill_command(args: List[str], proc: asyncio.subprocess.Process) -> None:
+    """Kill a command started by spawn_command.
+
+    Killing the cmd.exe running a batch file would leave ast-grep scanning as its orphan,
+    so then the whole process tree is killed instead.
+    """
+    if runs_in_shell(resolve_executable(args[0])):
+        try:
+            taskkill = await asyncio.create_subprocess_exec(
+                "taskkill", "/T", "/F", "/PID", str(proc.pid),
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.DEVNULL,
+            )
+            if await taskkill.wait() == 0:
+                return
+        except OSError:
+            pass
+    proc.kill()
+
+def check_returncode(args: List[str], returncode: int, stderr: bytes, ok_returncodes: tuple[int, ...] = (0,)) -> None:
+    """Raise a RuntimeError carrying the error output unless the exit code is one of ok_returncodes."""
+    if returncode not in ok_returncodes:
+        # Error output can contain non-UTF-8 file paths, which must not hide the actual error
+        stderr_msg = stderr.decode(errors="replace").strip() or "(no error output)"
+        error_msg = f"Command {args} failed with exit code {returncode}: {stderr_msg}"
+        raise RuntimeError(error_msg)
+
+async def run_command(
+    args: List[str], input_bytes: Optional[bytes] = None, ok_returncodes: tuple[int, ...] = (0,)
+) -> subprocess.CompletedProcess:
+    """Run a command without blocking the event loop, so tool calls can run concurrently.
+
+    stdin, stdout and stderr are passed through as raw bytes; callers decode only what they need.
+    Exit codes other than ok_returncodes raise a RuntimeError.
+    """
+    stdin = asyncio.subprocess.PIPE if input_bytes is not None else asyncio.subprocess.DEVNULL
+    async with _SUBPROCESS_SEMAPHORE:
+        proc = await spawn_command(args, stdin)
+        stdout, stderr = await proc.communicate(input_bytes)
+        returncode = await proc.wait()
+
+    check_returncode(args, returncode, stderr, ok_returncodes)
+    return subprocess.CompletedProcess(args, returncode, stdout, stderr)
+
+async def stream_command(args: List[str], ok_returncodes: tuple[int, ...] = (0,)) -> AsyncGenerator[bytes, None]:
+    """Run a command and yield its stdout line by line while it is still running.
+
+    If the consumer stops iterating early, the command is killed.
+    Exit codes other than ok_returncodes raise a RuntimeError. So does any other non-zero exit
+    code if the command wrote error output, since only stdout reaches the consumer.
+    """
+    async with _SUBPROCESS_SEMAPHORE:
+        proc = await spawn_command(args, asyncio.subprocess.DEVNULL)
+        assert proc.stdout is not None and proc.stderr is not None
+        # Drain stderr concurrently so a chatty child cannot block on a full pipe
+        stderr_task = asyncio.ensure_future(proc.stderr.read())
+        completed = False
+        try:
+            async for line in proc.stdout:
+                yield line
+            completed = True
+        finally:
+            if not completed and proc.returncode is None:
+                await kill_command(args, proc)
+            returncode = await proc.wait()
+            stderr = await stderr_task
+
+    check_returncode(args, returncode, stderr, ok_returncodes if not stderr.strip() else (0,))
+
+def ast_grep_command(command: str, args: List[str]) -> List[str]:
+    return ["ast-grep", command, *CONFIG_ARGS, *args]
+
+# Recent results of ast-grep calls that do not read a project folder (dump_syntax_tree,
+# test_match_code_rule), most recently used last. Agents often repeat them while refining a rule.
+_command_cache: OrderedDict[tuple, subprocess.CompletedProcess] = OrderedDict()
+
+async def run_ast_grep(
+    command: str, args: List[str], input_bytes: Optional[bytes] = None, ok_returncodes: tuple[int, ...] = (0,)
+) -> subprocess.CompletedProcess:
+    """Run ast-grep on the given arguments and stdin, reusing the result of an identical earlier call.
+
+    Only successful calls are cached; the key includes the config file's mtime so editing it takes effect.
+    """
+    # ok_returncodes is part of the key, as it decides whether a call succeeds at all
+    key = (command, tuple(args), input_bytes, ok_returncodes, CONFIG_PATH, config_mtime())
+    result = _command_cache.get(key)
+    if result is not None:
+        _command_cache.move_to_end(key)
+        return result
+    result = await run_command(ast_grep_command(command, args), input_bytes, ok_returncodes)
+    _command_cache[key] = result
+    if len(_command_cache) > RESULT_CACHE_SIZE:
+        _command_cache.popitem(last=False)
+    return result
+
+def stream_ast_grep(command: str, args: List[str]) -> AsyncGenerator[bytes, None]:
+    # `ast-grep run` exits with 1 and no error output when nothing matched
+    return stream_command(ast_grep_command(command, args), ok_returncodes=(0, 1))
 
 def run_mcp_server() -> None:
     """
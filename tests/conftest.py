@@ -0,0 +1,85 @@
+"""Shared test setup for ast-grep MCP server"""
+
+import json
+import subprocess
+from unittest.mock import AsyncMock, Mock, patch
+
+import pytest
+
+
+# Mock FastMCP to disable decoration
+class MockFastMCP:
+    """Mock FastMCP that returns functions unchanged"""
+
+    def __init__(self, name, **kwargs):
+        self.name = name
+
+    def tool(self, **kwargs):
+        """Decorator that returns the function unchanged"""
+
+        def decorator(func):
+            return func  # Return original function without modification
+
+        return decorator
+
+    def run(self, **kwargs):
+        """Mock run method"""
+        pass
+
+
+# Mock the Field function to return the default value
+def mock_field(**kwargs):
+    return kwargs.get("default")
+
+
+# Import main once with mocked decorators, before any test module imports the tools from it
+with patch("mcp.server.fastmcp.FastMCP", MockFastMCP):
+    with patch("pydantic.Field", mock_field):
+        import main
+
+
+@pytest.fixture
+def stream_of():
+    """Build stand-ins for stream_ast_grep that yield the given matches as streamed JSON lines"""
+
+    def build(matches):
+        # Serialize once; the stand-in may be called for several scans
+        lines = [json.dumps(match).encode() + b"\n" for match in matches]
+
+        async def stream(command, args):
+            for line in lines:
+                yield line
+
+        return stream
+
+    return build
+
+
+@pytest.fixture(autouse=True)
+def clear_result_caches():
+    """Start every test with empty result caches, so no test is answered from another one's results"""
+    main._result_cache.clear()
+    main._command_cache.clear()
+    main._inflight_scans.clear()
+
+
+@pytest.fixture
+def mock_result():
+    """A finished ast-grep call as returned by run_ast_grep, for tests to fill in"""
+    return subprocess.CompletedProcess([], 0, stdout=b"[]", stderr=b"")
+
+
+@pytest.fixture
+def mock_run_ast_grep(monkeypatch, mock_result):
+    """Replace run_ast_grep with a mock that returns mock_result"""
+    mock = AsyncMock(return_value=mock_result)
+    monkeypatch.setattr(main, "run_ast_grep", mock)
+    return mock
+
+
+@pytest.fixture
+def mock_stream_ast_grep(monkeypatch):
+    """Replace stream_ast_grep with a mock; tests set its side_effect, e.g. to stream_of(...)"""
+    mock = Mock()
+    monkeypatch.setattr(main, "stream_ast_grep", mock)
+    return mock
@@ -1,45 +1,11 @@
 """Integration tests for ast-grep MCP server"""
 
-import json
+import asyncio
 import os
-import sys
-from unittest.mock import Mock, patch
 
 import pytest
 
-# Add parent directory to path
-sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-
-
-# Mock FastMCP to disable decoration
-class MockFastMCP:
-    """Mock FastMCP that returns functions unchanged"""
-
-    def __init__(self, name):
-        self.name = name
-
-    def tool(self, **kwargs):
-        """Decorator that returns the function unchanged"""
-
-        def decorator(func):
-            return func  # Return original function without modification
-
-        return decorator
-
-    def run(self, **kwargs):
-        """Mock run method"""
-        pass
-
-
-# Mock the Field function to return the default value
-def mock_field(**kwargs):
-    return kwargs.get("default")
-
-
-# Import with mocked decorators
-with patch("mcp.server.fastmcp.FastMCP", MockFastMCP):
-    with patch("pydantic.Field", mock_field):
-        from main import find_code, find_code_by_rule
+from main import dump_syntax_tree, find_code, find_code_batch, find_code_by_rule
 
 
 @pytest.fixture
@@ -53,82 +19,117 @@ class TestIntegration:
 
     def test_find_code_text_format(self, fixtures_dir):
         """Test find_code with text format"""
-        result = find_code(
+        result = asyncio.run(find_code(
             project_folder=fixtures_dir,
             pattern="def $NAME($$$)",
             language="python",
             output_format="text",
-        )
+        ))
 
-        assert "hello" in result
-        assert "add" in result
-        assert "Found" in result and "matches" in result
+        example = os.path.join(fixtures_dir, "example.py")
+        assert result == (
+            f'Found 3 matches:\n\n{example}:1-2\ndef hello():\n    print("Hello, World!")'
+            f"\n\n{example}:5-6\ndef add(a, b):\n    return a + b"
+            f"\n\n{example}:10-11\ndef multiply(self, x, y):\n        return x * y"
+        )
 
     def test_find_code_json_format(self, fixtures_dir):
         """Test find_code with JSON format"""
-        result = find_code(
+        result = asyncio.run(find_code(
             project_folder=fixtures_dir,
             pattern="def $NAME($$$)",
             language="python",
             output_format="json",
-        )
+        ))
 
         assert len(result) >= 2
         assert any("hello" in str(match) for match in result)
         assert any("add" in str(match) for match in result)
 
-    @patch("main.run_ast_grep")
-    def test_find_code_by_rule(self, mock_run, fixtures_dir):
+    def test_find_code_by_rule(self, mock_stream_ast_grep, stream_of, fixtures_dir):
         """Test find_code_by_rule with mocked ast-grep"""
         # Mock the response with JSON format (since we always use JSON internally)
-        mock_result = Mock()
         mock_matches = [{
             "text": "class Calculator:\n    pass",
             "file": "fixtures/example.py",
             "range": {"start": {"line": 6}, "end": {"line": 7}}
         }]
-        mock_result.stdout = json.dumps(mock_matches)
-        mock_run.return_value = mock_result
+        mock_stream_ast_grep.side_effect = stream_of(mock_matches)
 
         yaml_rule = """id: test
 language: python
 rule:
   pattern: class $NAME"""
 
-        result = find_code_by_rule(
+        result = asyncio.run(find_code_by_rule(
             project_folder=fixtures_dir, yaml=yaml_rule, output_format="text"
-        )
+        ))
 
-        assert "Calculator" in result
-        assert "Found 1 match" in result
-        assert "fixtures/example.py:7-8" in result
+        assert result == "Found 1 matches:\n\nfixtures/example.py:7-8\nclass Calculator:\n    pass"
 
         # Verify the command was called correctly
-        mock_run.assert_called_once_with(
-            "scan", ["--inline-rules", yaml_rule, "--json", fixtures_dir]
+        mock_stream_ast_grep.assert_called_once_with(
+            "scan", ["--inline-rules", yaml_rule, "--json=stream", fixtures_dir]
         )
 
     def test_find_code_with_max_results(self, fixtures_dir):
         """Test find_code with max_results parameter"""
-        result = find_code(
+        result = asyncio.run(find_code(
             project_folder=fixtures_dir,
             pattern="def $NAME($$$)",
             language="python",
             max_results=1,
             output_format="text",
-        )
+        ))
 
-        # The new format says "showing first X of Y" instead of "limited to X"
-        assert "showing first 1 of" in result or "Found 1 match" in result
-        # Should only have one match in the output
-        assert result.count("def ") == 1
+        # The scan stops at the second match, so the total stays unknown
+        example = os.path.join(fixtures_dir, "example.py")
+        assert result == (
+            f'Found 1 matches (showing first 1, more available):\n\n{example}:1-2\ndef hello():\n    print("Hello, World!")'
+        )
 
     def test_find_code_no_matches(self, fixtures_dir):
         """Test find_code when no matches are found"""
-        result = find_code(
+        result = asyncio.run(find_code(
             project_folder=fixtures_dir,
             pattern="nonexistent_pattern_xyz",
             output_format="text",
-        )
+        ))
 
         assert result == "No matches found"
+
+    def test_find_code_batch(self, fixtures_dir):
+        """Test find_code_batch with one matching and one non-matching pattern"""
+        result = asyncio.run(find_code_batch(
+            project_folder=fixtures_dir,
+            patterns=["class $NAME", "nonexistent_pattern_xyz"],
+            language="python",
+            output_format="json",
+        ))
+
+        assert [m["text"].split(":")[0] for m in result["class $NAME"]] == ["class Calculator"]
+        assert result["nonexistent_pattern_xyz"] == []
+
+    def test_find_code_batch_single_scan(self, fixtures_dir):
+        """Test that patterns matched in one scan report the same matches as find_code"""
+        result = asyncio.run(find_code_batch(
+            project_folder=fixtures_dir,
+            patterns=["return $X", "nonexistent_pattern_xyz"],
+            language="python",
+            output_format="json",
+        ))
+        expected = asyncio.run(find_code(
+            project_folder=fixtures_dir, pattern="return $X", language="python", output_format="json"
+        ))
+
+        assert sorted(result["return $X"], key=lambda m: m["range"]["start"]["line"]) == expected
+        assert result["nonexistent_pattern_xyz"] == []
+
+    def test_dump_syntax_tree(self, tmp_path, monkeypatch):
+        """Test dump_syntax_tree in a working directory without any matching file"""
+        monkeypatch.chdir(tmp_path)
+
+        result = asyncio.run(dump_syntax_tree(code="const x = 1", language="javascript", format="cst"))
+
+        assert result.startswith("Debug CST:")
+        assert "lexical_declaration" in result
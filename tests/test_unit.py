@@ -1,100 +1,111 @@
 """Unit tests for ast-grep MCP server"""
 
+import asyncio
+import gzip
 import json
 import os
-import subprocess
+import shutil
 import sys
-from unittest.mock import Mock, patch
+from unittest.mock import AsyncMock, Mock, patch
 
 import pytest
 
-# Add the parent directory to the path
-sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-
-
-# Mock FastMCP to disable decoration
-class MockFastMCP:
-    """Mock FastMCP that returns functions unchanged"""
-
-    def __init__(self, name):
-        self.name = name
-
-    def tool(self, **kwargs):
-        """Decorator that returns the function unchanged"""
-
-        def decorator(func):
-            return func  # Return original function without modification
-
-        return decorator
-
-    def run(self, **kwargs):
-        """Mock run method"""
-        pass
-
-
-# Mock the Field function to return the default value
-def mock_field(**kwargs):
-    return kwargs.get("default")
-
-
-# Patch the imports before loading main
-with patch("mcp.server.fastmcp.FastMCP", MockFastMCP):
-    with patch("pydantic.Field", mock_field):
-        from main import (
-            dump_syntax_tree,
-            find_code,
-            find_code_by_rule,
-            format_matches_as_text,
-            run_ast_grep,
-            run_command,
-        )
-
-        # Import with different name to avoid pytest treating it as a test
-        from main import test_match_code_rule as match_code_rule
+import main
+from main import (
+    dump_syntax_tree,
+    find_code,
+    find_code_batch,
+    find_code_by_rule,
+    format_matches_as_text,
+    kill_command,
+    parse_args_and_get_config,
+    project_fingerprint,
+    run_ast_grep,
+    run_command,
+    search_project,
+    stream_command,
+)
+
+# Import with different name to avoid pytest treating it as a test
+from main import test_match_code_rule as match_code_rule
+
+# Search results shared by several tests, built once at import
+DEF_MATCHES = [
+    {"text": "def foo():\n    pass", "file": "file.py",
+     "range": {"start": {"line": 0}, "end": {"line": 1}}},
+    {"text": "def bar():\n    return", "file": "file.py",
+     "range": {"start": {"line": 4}, "end": {"line": 5}}},
+]
+CLASS_MATCHES = [
+    {"text": "class Foo:\n    pass", "file": "file.py",
+     "range": {"start": {"line": 0}, "end": {"line": 1}}},
+    {"text": "class Bar:\n    pass", "file": "file.py",
+     "range": {"start": {"line": 9}, "end": {"line": 10}}},
+]
+NUMBERED_MATCHES = [
+    {"text": f"match{i}", "file": "f.py", "range": {"start": {"line": i - 1}, "end": {"line": i - 1}}}
+    for i in range(1, 5)
+]
+# format_matches_as_text cases by id: the matches and the expected text
+FORMAT_CASES = {
+    "empty": ([], ""),
+    "single_line": (
+        [{"text": "const x = 1", "file": "test.js", "range": {"start": {"line": 4}, "end": {"line": 4}}}],
+        "test.js:5\nconst x = 1",
+    ),
+    "multi_line": (
+        [{"text": "def foo():\n    return 42", "file": "test.py", "range": {"start": {"line": 9}, "end": {"line": 10}}}],
+        "test.py:10-11\ndef foo():\n    return 42",
+    ),
+    "multiple": (
+        [
+            {"text": "match1", "file": "file1.py", "range": {"start": {"line": 0}, "end": {"line": 0}}},
+            {"text": "match2\nline2", "file": "file2.py", "range": {"start": {"line": 5}, "end": {"line": 6}}},
+        ],
+        "file1.py:1\nmatch1\n\nfile2.py:6-7\nmatch2\nline2",
+    ),
+    # Missing fields fall back to defaults
+    "missing_fields": ([{"text": "x = 1", "range": {"start": {"line": 2}}}], ":3-1\nx = 1"),
+}
+CLASS_RULE = """id: test
+language: python
+rule:
+  pattern: 'class $NAME'
+"""
 
 
 class TestDumpSyntaxTree:
     """Test the dump_syntax_tree function"""
 
-    @patch("main.run_ast_grep")
-    def test_dump_syntax_tree_cst(self, mock_run):
-        """Test dumping CST format"""
-        mock_result = Mock()
-        mock_result.stderr = "ROOT@0..10"
-        mock_run.return_value = mock_result
+    @pytest.mark.parametrize(
+        "code,language,format,stderr,expected",
+        [
+            ("const x = 1", "javascript", "cst", b"ROOT@0..10\n", "ROOT@0..10"),
+            ("$VAR", "python", "pattern", b"pattern_node", "pattern_node"),
+        ],
+        ids=["cst", "pattern"],
+    )
+    def test_dump_syntax_tree(self, mock_run_ast_grep, mock_result, code, language, format, stderr, expected):
+        """Test that the debug dump of the requested format is returned without surrounding whitespace"""
+        mock_result.stderr = stderr
 
-        result = dump_syntax_tree("const x = 1", "javascript", "cst")
+        result = asyncio.run(dump_syntax_tree(code, language, format))
 
-        assert result == "ROOT@0..10"
-        mock_run.assert_called_once_with(
+        assert result == expected
+        mock_run_ast_grep.assert_called_once_with(
             "run",
-            ["--pattern", "const x = 1", "--lang", "javascript", "--debug-query=cst"],
-        )
-
-    @patch("main.run_ast_grep")
-    def test_dump_syntax_tree_pattern(self, mock_run):
-        """Test dumping pattern format"""
-        mock_result = Mock()
-        mock_result.stderr = "pattern_node"
-        mock_run.return_value = mock_result
-
-        result = dump_syntax_tree("$VAR", "python", "pattern")
-
-        assert result == "pattern_node"
-        mock_run.assert_called_once_with(
-            "run", ["--pattern", "$VAR", "--lang", "python", "--debug-query=pattern"]
+            ["--pattern", code, "--lang", language, f"--debug-query={format}", "--stdin"],
+            input_bytes=b"",
+            ok_returncodes=(0, 1),
         )
 
 
 class TestTestMatchCodeRule:
     """Test the test_match_code_rule function"""
 
-    @patch("main.run_ast_grep")
-    def test_match_found(self, mock_run):
+    def test_match_found(self, mock_run_ast_grep, mock_result):
         """Test when matches are found"""
-        mock_result = Mock()
-        mock_result.stdout = '[{"text": "def foo(): pass"}]'
-        mock_run.return_value = mock_result
+        mock_result.stdout = b'[{"text": "def foo(): pass"}]'
 
         yaml_rule = """id: test
 language: python
@@ -103,323 +114,376 @@ rule:
 """
         code = "def foo(): pass"
 
-        result = match_code_rule(code, yaml_rule)
+        result = asyncio.run(match_code_rule(code, yaml_rule))
 
         assert result == [{"text": "def foo(): pass"}]
-        mock_run.assert_called_once_with(
-            "scan", ["--inline-rules", yaml_rule, "--json", "--stdin"], input_text=code
+        mock_run_ast_grep.assert_called_once_with(
+            "scan", ["--inline-rules", yaml_rule, "--json=compact", "--stdin"], input_bytes=code.encode()
         )
 
-    @patch("main.run_ast_grep")
-    def test_no_match(self, mock_run):
+    def test_no_match(self, mock_run_ast_grep, mock_result):
         """Test when no matches are found"""
-        mock_result = Mock()
-        mock_result.stdout = "[]"
-        mock_run.return_value = mock_result
+        mock_result.stdout = b"[]"
 
-        yaml_rule = """id: test
-language: python
-rule:
-  pattern: 'class $NAME'
-"""
+        yaml_rule = CLASS_RULE
         code = "def foo(): pass"
 
         with pytest.raises(ValueError, match="No matches found"):
-            match_code_rule(code, yaml_rule)
+            asyncio.run(match_code_rule(code, yaml_rule))
+
+    def test_empty_output(self, mock_run_ast_grep, mock_result):
+        """Test that empty output is reported as no matches instead of a JSON decode error"""
+        mock_result.stdout = b"\n"
+
+        with pytest.raises(ValueError, match="No matches found"):
+            asyncio.run(match_code_rule("def foo(): pass", "id: test"))
 
 
 class TestFindCode:
     """Test the find_code function"""
 
-    @patch("main.run_ast_grep")
-    def test_text_format_with_results(self, mock_run):
-        """Test text format output with results"""
-        mock_result = Mock()
-        mock_matches = [
-            {"text": "def foo():\n    pass", "file": "file.py",
-             "range": {"start": {"line": 0}, "end": {"line": 1}}},
-            {"text": "def bar():\n    return", "file": "file.py",
-             "range": {"start": {"line": 4}, "end": {"line": 5}}}
-        ]
-        mock_result.stdout = json.dumps(mock_matches)
-        mock_run.return_value = mock_result
-
-        result = find_code(
+    @pytest.mark.parametrize(
+        "output_format,expected",
+        [
+            ("text", "Found 2 matches:\n\nfile.py:1-2\ndef foo():\n    pass\n\nfile.py:5-6\ndef bar():\n    return"),
+            ("json", DEF_MATCHES),
+        ],
+        ids=["text", "json"],
+    )
+    def test_format_with_results(self, mock_stream_ast_grep, stream_of, output_format, expected):
+        """Test text and JSON output with results"""
+        mock_stream_ast_grep.side_effect = stream_of(DEF_MATCHES)
+
+        result = asyncio.run(find_code(
             project_folder="/test/path",
             pattern="def $NAME():",
             language="python",
-            output_format="text",
-        )
+            output_format=output_format,
+        ))
 
-        assert "Found 2 matches:" in result
-        assert "def foo():" in result
-        assert "def bar():" in result
-        assert "file.py:1-2" in result
-        assert "file.py:5-6" in result
-        mock_run.assert_called_once_with(
-            "run", ["--pattern", "def $NAME():", "--lang", "python", "--json", "/test/path"]
+        assert result == expected
+        mock_stream_ast_grep.assert_called_once_with(
+            "run", ["--pattern", "def $NAME():", "--lang", "python", "--json=stream", "/test/path"]
         )
 
-    @patch("main.run_ast_grep")
-    def test_text_format_no_results(self, mock_run):
+    def test_text_format_no_results(self, mock_stream_ast_grep, stream_of):
         """Test text format output with no results"""
-        mock_result = Mock()
-        mock_result.stdout = "[]"
-        mock_run.return_value = mock_result
+        mock_stream_ast_grep.side_effect = stream_of([])
 
-        result = find_code(
+        result = asyncio.run(find_code(
             project_folder="/test/path", pattern="nonexistent", output_format="text"
-        )
+        ))
 
         assert result == "No matches found"
-        mock_run.assert_called_once_with(
-            "run", ["--pattern", "nonexistent", "--json", "/test/path"]
+        mock_stream_ast_grep.assert_called_once_with(
+            "run", ["--pattern", "nonexistent", "--json=stream", "/test/path"]
         )
 
-    @patch("main.run_ast_grep")
-    def test_text_format_with_max_results(self, mock_run):
+    def test_text_format_with_max_results(self, mock_stream_ast_grep, stream_of):
         """Test text format with max_results limit"""
-        mock_result = Mock()
-        mock_matches = [
-            {"text": "match1", "file": "f.py", "range": {"start": {"line": 0}, "end": {"line": 0}}},
-            {"text": "match2", "file": "f.py", "range": {"start": {"line": 1}, "end": {"line": 1}}},
-            {"text": "match3", "file": "f.py", "range": {"start": {"line": 2}, "end": {"line": 2}}},
-            {"text": "match4", "file": "f.py", "range": {"start": {"line": 3}, "end": {"line": 3}}},
-        ]
-        mock_result.stdout = json.dumps(mock_matches)
-        mock_run.return_value = mock_result
+        mock_stream_ast_grep.side_effect = stream_of(NUMBERED_MATCHES)
 
-        result = find_code(
+        result = asyncio.run(find_code(
             project_folder="/test/path",
             pattern="pattern",
             max_results=2,
             output_format="text",
-        )
+        ))
 
-        assert "Found 2 matches (showing first 2 of 4):" in result
-        assert "match1" in result
-        assert "match2" in result
-        assert "match3" not in result
-
-    @patch("main.run_ast_grep")
-    def test_json_format(self, mock_run):
-        """Test JSON format output"""
-        mock_result = Mock()
-        mock_matches = [
-            {"text": "def foo():", "file": "test.py"},
-            {"text": "def bar():", "file": "test.py"},
-        ]
-        mock_result.stdout = json.dumps(mock_matches)
-        mock_run.return_value = mock_result
+        assert result == "Found 2 matches (showing first 2, more available):\n\nf.py:1\nmatch1\n\nf.py:2\nmatch2"
 
-        result = find_code(
-            project_folder="/test/path", pattern="def $NAME():", output_format="json"
-        )
-
-        assert result == mock_matches
-        mock_run.assert_called_once_with(
-            "run", ["--pattern", "def $NAME():", "--json", "/test/path"]
-        )
-
-    @patch("main.run_ast_grep")
-    def test_json_format_with_max_results(self, mock_run):
+    def test_json_format_with_max_results(self, mock_stream_ast_grep, stream_of):
         """Test JSON format with max_results limit"""
-        mock_result = Mock()
         mock_matches = [{"text": "match1"}, {"text": "match2"}, {"text": "match3"}]
-        mock_result.stdout = json.dumps(mock_matches)
-        mock_run.return_value = mock_result
+        mock_stream_ast_grep.side_effect = stream_of(mock_matches)
 
-        result = find_code(
+        result = asyncio.run(find_code(
             project_folder="/test/path",
             pattern="pattern",
             max_results=2,
             output_format="json",
-        )
+        ))
 
-        assert len(result) == 2
-        assert result[0]["text"] == "match1"
-        assert result[1]["text"] == "match2"
+        assert result == [{"text": "match1"}, {"text": "match2"}]
 
     def test_invalid_output_format(self):
         """Test with invalid output format"""
         with pytest.raises(ValueError, match="Invalid output_format"):
-            find_code(
+            asyncio.run(find_code(
                 project_folder="/test/path", pattern="pattern", output_format="invalid"
-            )
+            ))
 
 
 class TestFindCodeByRule:
     """Test the find_code_by_rule function"""
 
-    @patch("main.run_ast_grep")
-    def test_text_format_with_results(self, mock_run):
-        """Test text format output with results"""
-        mock_result = Mock()
-        mock_matches = [
-            {"text": "class Foo:\n    pass", "file": "file.py",
-             "range": {"start": {"line": 0}, "end": {"line": 1}}},
-            {"text": "class Bar:\n    pass", "file": "file.py",
-             "range": {"start": {"line": 9}, "end": {"line": 10}}}
-        ]
-        mock_result.stdout = json.dumps(mock_matches)
-        mock_run.return_value = mock_result
+    @pytest.mark.parametrize(
+        "output_format,expected",
+        [
+            ("text", "Found 2 matches:\n\nfile.py:1-2\nclass Foo:\n    pass\n\nfile.py:10-11\nclass Bar:\n    pass"),
+            ("json", CLASS_MATCHES),
+        ],
+        ids=["text", "json"],
+    )
+    def test_format_with_results(self, mock_stream_ast_grep, stream_of, output_format, expected):
+        """Test text and JSON output with results"""
+        mock_stream_ast_grep.side_effect = stream_of(CLASS_MATCHES)
+
+        result = asyncio.run(find_code_by_rule(
+            project_folder="/test/path", yaml=CLASS_RULE, output_format=output_format
+        ))
 
-        yaml_rule = """id: test
-language: python
-rule:
-  pattern: 'class $NAME'
-"""
-
-        result = find_code_by_rule(
-            project_folder="/test/path", yaml=yaml_rule, output_format="text"
+        assert result == expected
+        mock_stream_ast_grep.assert_called_once_with(
+            "scan", ["--inline-rules", CLASS_RULE, "--json=stream", "/test/path"]
         )
 
-        assert "Found 2 matches:" in result
-        assert "class Foo:" in result
-        assert "class Bar:" in result
-        assert "file.py:1-2" in result
-        assert "file.py:10-11" in result
-        mock_run.assert_called_once_with(
-            "scan", ["--inline-rules", yaml_rule, "--json", "/test/path"]
-        )
 
-    @patch("main.run_ast_grep")
-    def test_json_format(self, mock_run):
-        """Test JSON format output"""
-        mock_result = Mock()
-        mock_matches = [{"text": "class Foo:", "file": "test.py"}]
-        mock_result.stdout = json.dumps(mock_matches)
-        mock_run.return_value = mock_result
+class TestFindCodeBatch:
+    """Test the find_code_batch function"""
 
-        yaml_rule = """id: test
-language: python
-rule:
-  pattern: 'class $NAME'
-"""
+    def test_text_format(self, mock_stream_ast_grep, stream_of):
+        """Test that each pattern gets its own section"""
+        mock_stream_ast_grep.side_effect = stream_of([
+            {"text": "class Foo: pass", "file": "a.py",
+             "range": {"start": {"line": 2}, "end": {"line": 2}}, "ruleId": "p0"},
+        ])
+
+        result = asyncio.run(find_code_batch(
+            project_folder="/test/path", patterns=["class $NAME:\n    pass", "def $NAME()"], language="python"
+        ))
 
-        result = find_code_by_rule(
-            project_folder="/test/path", yaml=yaml_rule, output_format="json"
+        assert result == (
+            "Pattern: class $NAME:\n    pass\nFound 1 matches:\n\na.py:3\nclass Foo: pass"
+            "\n\nPattern: def $NAME()\nNo matches found"
         )
 
-        assert result == mock_matches
-        mock_run.assert_called_once_with(
-            "scan", ["--inline-rules", yaml_rule, "--json", "/test/path"]
+    def test_language_runs_one_scan(self, mock_stream_ast_grep, stream_of):
+        """Test that all patterns become rules of a single scan and matches are split by rule id"""
+        mock_stream_ast_grep.side_effect = stream_of([
+            {"text": "a", "ruleId": "p1", "severity": "hint", "note": None, "message": "", "labels": []},
+            {"text": "b", "ruleId": "p0", "severity": "hint", "note": None, "message": "", "labels": []},
+            {"text": "c", "ruleId": "p1", "severity": "hint", "note": None, "message": "", "labels": []},
+        ])
+
+        result = asyncio.run(find_code_batch(
+            project_folder="/test/path", patterns=['print("$A")', "return $X"], language="python",
+            max_results=1, output_format="json",
+        ))
+
+        assert result == {'print("$A")': [{"text": "b"}], "return $X": [{"text": "a"}]}
+        rules = (
+            'id: p0\nlanguage: "python"\nrule:\n  pattern: "print(\\"$A\\")"'
+            '\n---\nid: p1\nlanguage: "python"\nrule:\n  pattern: "return $X"'
         )
+        mock_stream_ast_grep.assert_called_once_with("scan", ["--inline-rules", rules, "--json=stream", "/test/path"])
+
+    def test_falls_back_when_scan_rejects_pattern(self, mock_stream_ast_grep):
+        """Test that patterns are run one by one if ast-grep does not accept them as rules"""
+        async def stream(command, args):
+            if command == "scan":
+                raise RuntimeError("Cannot parse rule INLINE_RULES")
+            yield json.dumps({"text": args[1]}).encode() + b"\n"
+
+        mock_stream_ast_grep.side_effect = stream
+
+        result = asyncio.run(find_code_batch(
+            project_folder="/test/path", patterns=["class $NAME", "def $F"], language="python",
+            output_format="json",
+        ))
+
+        assert result == {"class $NAME": [{"text": "class $NAME"}], "def $F": [{"text": "def $F"}]}
+
+    @patch("os.cpu_count", return_value=8)
+    def test_json_format_splits_threads(self, _mock_cpu_count, mock_stream_ast_grep, stream_of):
+        """Test JSON output and that the cores are split between the concurrent scans"""
+        mock_stream_ast_grep.side_effect = stream_of([{"text": "x"}])
+
+        result = asyncio.run(find_code_batch(
+            project_folder="/test/path", patterns=["a", "b"], output_format="json"
+        ))
+
+        assert result == {"a": [{"text": "x"}], "b": [{"text": "x"}]}
+        mock_stream_ast_grep.assert_any_call("run", ["--pattern", "a", "--json=stream", "--threads", "4", "/test/path"])
+        mock_stream_ast_grep.assert_any_call("run", ["--pattern", "b", "--json=stream", "--threads", "4", "/test/path"])
 
 
 class TestRunCommand:
     """Test the run_command function"""
 
-    @patch("subprocess.run")
-    def test_successful_command(self, mock_run):
+    @staticmethod
+    def _mock_process(returncode=0, stdout=b"", stderr=b""):
+        return Mock(
+            returncode=returncode,
+            communicate=AsyncMock(return_value=(stdout, stderr)),
+            wait=AsyncMock(return_value=returncode),
+        )
+
+    @pytest.fixture(autouse=True)
+    def _patch_exec(self, monkeypatch):
+        """Replace asyncio.create_subprocess_exec for every test of the class"""
+        self.mock_exec = AsyncMock(return_value=self._mock_process())
+        monkeypatch.setattr(asyncio, "create_subprocess_exec", self.mock_exec)
+
+    def test_successful_command(self):
         """Test successful command execution"""
-        mock_result = Mock()
-        mock_result.returncode = 0
-        mock_result.stdout = "output"
-        mock_run.return_value = mock_result
+        self.mock_exec.return_value = self._mock_process(stdout=b"output")
 
-        result = run_command(["echo", "test"])
+        result = asyncio.run(run_command(["echo", "test"]))
 
-        assert result.stdout == "output"
-        mock_run.assert_called_once_with(
-            ["echo", "test"], capture_output=True, input=None, text=True, check=True, shell=False
+        assert result.stdout == b"output"
+        self.mock_exec.assert_called_once_with(
+            shutil.which("echo"), "test",
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            limit=main._STREAM_LINE_LIMIT,
         )
+        self.mock_exec.return_value.communicate.assert_called_once_with(None)
+
+    def test_command_with_input(self):
+        """Test that input bytes are piped to the command's stdin unchanged"""
+        self.mock_exec.return_value = self._mock_process(stdout=b"[]")
 
-    @patch("subprocess.run")
-    def test_command_failure(self, mock_run):
+        asyncio.run(run_command(["cat"], input_bytes=b"def foo(): pass"))
+
+        assert self.mock_exec.call_args.kwargs["stdin"] == asyncio.subprocess.PIPE
+        self.mock_exec.return_value.communicate.assert_called_once_with(b"def foo(): pass")
+
+    def test_command_failure(self):
         """Test command execution failure"""
-        mock_run.side_effect = subprocess.CalledProcessError(
-            1, ["false"], stderr="error message"
-        )
+        self.mock_exec.return_value = self._mock_process(returncode=1, stderr=b"error message")
 
-        with pytest.raises(RuntimeError, match="failed with exit code 1"):
-            run_command(["false"])
+        with pytest.raises(RuntimeError, match="failed with exit code 1: error message"):
+            asyncio.run(run_command(["false"]))
 
-    @patch("subprocess.run")
-    def test_command_not_found(self, mock_run):
+    def test_command_failure_with_undecodable_output(self):
+        """Test that error output which is not valid UTF-8 still yields the command's error"""
+        self.mock_exec.return_value = self._mock_process(returncode=2, stderr=b"cannot read \xff.py")
+
+        with pytest.raises(RuntimeError, match="failed with exit code 2: cannot read \ufffd.py"):
+            asyncio.run(run_command(["false"]))
+
+    @patch("sys.platform", "win32")
+    @patch("main.resolve_executable", return_value="C:\\npm\\ast-grep.CMD")
+    @patch("asyncio.create_subprocess_shell")
+    def test_windows_batch_file_uses_shell(self, mock_shell, _mock_resolve):
+        """Test that a batch file installed by npm is run through cmd.exe"""
+        mock_shell.return_value = self._mock_process()
+
+        asyncio.run(run_command(["ast-grep", "run", "--pattern", "a b"]))
+
+        assert mock_shell.call_args.args == ('ast-grep run --pattern "a b"',)
+
+    @patch("sys.platform", "win32")
+    @patch("main.resolve_executable", return_value="C:\\Python\\Scripts\\ast-grep.exe")
+    def test_windows_executable_runs_without_shell(self, _mock_resolve):
+        """Test that an ast-grep.exe is started directly"""
+        asyncio.run(run_command(["ast-grep", "run"]))
+
+        assert self.mock_exec.call_args.args == ("C:\\Python\\Scripts\\ast-grep.exe", "run")
+
+    def test_command_not_found(self):
         """Test when command is not found"""
-        mock_run.side_effect = FileNotFoundError()
+        self.mock_exec.side_effect = FileNotFoundError()
 
         with pytest.raises(RuntimeError, match="not found"):
-            run_command(["nonexistent"])
+            asyncio.run(run_command(["nonexistent"]))
+
+
+class TestStreamCommand:
+    """Test the stream_command function"""
+
+    @staticmethod
+    async def _collect(args, limit=None, ok_returncodes=(0,)):
+        lines = []
+        stream = stream_command(args, ok_returncodes)
+        async for line in stream:
+            lines.append(line)
+            if len(lines) == limit:
+                await stream.aclose()
+                break
+        return lines
+
+    def test_yields_lines(self):
+        """Test that stdout is yielded line by line"""
+        lines = asyncio.run(self._collect([sys.executable, "-c", "print('a'); print('b')"]))
+
+        assert lines == [b"a\n", b"b\n"]
+
+    def test_command_failure(self):
+        """Test that a non-zero exit code raises after the output is consumed"""
+        args = [sys.executable, "-c", "import sys; print('a'); sys.exit('boom')"]
+
+        with pytest.raises(RuntimeError, match="failed with exit code 1: boom"):
+            asyncio.run(self._collect(args))
+
+    def test_ok_returncodes(self):
+        """Test that an accepted non-zero exit code only passes without error output"""
+        silent = [sys.executable, "-c", "import sys; sys.exit(1)"]
+        failing = [sys.executable, "-c", "import sys; sys.exit('boom')"]
+
+        assert asyncio.run(self._collect(silent, ok_returncodes=(0, 1))) == []
+        with pytest.raises(RuntimeError, match="failed with exit code 1"):
+            asyncio.run(self._collect(silent))
+        with pytest.raises(RuntimeError, match="failed with exit code 1: boom"):
+            asyncio.run(self._collect(failing, ok_returncodes=(0, 1)))
+
+    def test_early_close_kills_command(self):
+        """Test that closing the stream early stops the command instead of waiting for it"""
+        args = [sys.executable, "-c", "import time\nwhile True: print('x', flush=True); time.sleep(0.01)"]
+
+        assert asyncio.run(self._collect(args, limit=2)) == [b"x\n", b"x\n"]
+
+    @pytest.mark.parametrize("taskkill_returncode,killed", [(0, False), (128, True)], ids=["taskkill", "fallback"])
+    @patch("main.runs_in_shell", return_value=True)
+    @patch("main.asyncio.create_subprocess_exec")
+    def test_kill_shell_command_kills_process_tree(self, mock_exec, mock_shell, taskkill_returncode, killed):
+        """Test that a command run through cmd.exe is killed with its children, falling back to killing the shell"""
+        mock_exec.return_value.wait = AsyncMock(return_value=taskkill_returncode)
+        proc = Mock(pid=42)
+
+        asyncio.run(kill_command(["ast-grep", "run"], proc))
+
+        mock_exec.assert_called_once_with(
+            "taskkill", "/T", "/F", "/PID", "42",
+            stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL,
+        )
+        assert proc.kill.called == killed
 
 
 class TestFormatMatchesAsText:
     """Test the format_matches_as_text helper function"""
 
-    def test_empty_matches(self):
-        """Test with empty matches list"""
-        result = format_matches_as_text([])
-        assert result == ""
-
-    def test_single_line_match(self):
-        """Test formatting a single-line match"""
-        matches = [
-            {
-                "text": "const x = 1",
-                "file": "test.js",
-                "range": {"start": {"line": 4}, "end": {"line": 4}}
-            }
-        ]
-        result = format_matches_as_text(matches)
-        assert result == "test.js:5\nconst x = 1"
-
-    def test_multi_line_match(self):
-        """Test formatting a multi-line match"""
-        matches = [
-            {
-                "text": "def foo():\n    return 42",
-                "file": "test.py",
-                "range": {"start": {"line": 9}, "end": {"line": 10}}
-            }
-        ]
-        result = format_matches_as_text(matches)
-        assert result == "test.py:10-11\ndef foo():\n    return 42"
-
-    def test_multiple_matches(self):
-        """Test formatting multiple matches"""
-        matches = [
-            {
-                "text": "match1",
-                "file": "file1.py",
-                "range": {"start": {"line": 0}, "end": {"line": 0}}
-            },
-            {
-                "text": "match2\nline2",
-                "file": "file2.py",
-                "range": {"start": {"line": 5}, "end": {"line": 6}}
-            }
-        ]
-        result = format_matches_as_text(matches)
-        expected = "file1.py:1\nmatch1\n\nfile2.py:6-7\nmatch2\nline2"
-        assert result == expected
+    @pytest.mark.parametrize("matches,expected", FORMAT_CASES.values(), ids=FORMAT_CASES.keys())
+    def test_format(self, matches, expected):
+        """Test formatting matches as text"""
+        assert format_matches_as_text(matches) == expected
 
 
 class TestRunAstGrep:
     """Test the run_ast_grep function"""
 
     @patch("main.run_command")
-    @patch("main.CONFIG_PATH", None)
-    def test_without_config(self, mock_run):
+    @patch("main.CONFIG_ARGS", ())
+    def test_without_config(self, mock_run, mock_result):
         """Test running ast-grep without config"""
-        mock_result = Mock()
         mock_run.return_value = mock_result
 
-        result = run_ast_grep("run", ["--pattern", "test"])
+        result = asyncio.run(run_ast_grep("run", ["--pattern", "test"]))
 
-        assert result == mock_result
-        mock_run.assert_called_once_with(["ast-grep", "run", "--pattern", "test"], None)
+        assert result is mock_result
+        mock_run.assert_called_once_with(["ast-grep", "run", "--pattern", "test"], None, (0,))
 
     @patch("main.run_command")
-    @patch("main.CONFIG_PATH", "/path/to/config.yaml")
-    def test_with_config(self, mock_run):
+    @patch("main.CONFIG_ARGS", ("--config", "/path/to/config.yaml"))
+    def test_with_config(self, mock_run, mock_result):
         """Test running ast-grep with config"""
-        mock_result = Mock()
         mock_run.return_value = mock_result
 
-        result = run_ast_grep("scan", ["--inline-rules", "rule"])
+        result = asyncio.run(run_ast_grep("scan", ["--inline-rules", "rule"]))
 
-        assert result == mock_result
+        assert result is mock_result
         mock_run.assert_called_once_with(
             [
                 "ast-grep",
@@ -430,8 +494,398 @@ class TestRunAstGrep:
                 "rule",
             ],
             None,
+            (0,),
+        )
+
+    @patch("main.run_command")
+    @patch("main.CONFIG_ARGS", ())
+    def test_repeated_call_uses_cache(self, mock_run):
+        """Test that an identical call reuses the earlier result while a different stdin or exit code check does not"""
+        mock_run.return_value = Mock()
+
+        first = asyncio.run(run_ast_grep("scan", ["--inline-rules", "memo", "--stdin"], b"a = 1"))
+        second = asyncio.run(run_ast_grep("scan", ["--inline-rules", "memo", "--stdin"], b"a = 1"))
+        asyncio.run(run_ast_grep("scan", ["--inline-rules", "memo", "--stdin"], b"a = 2"))
+        asyncio.run(run_ast_grep("scan", ["--inline-rules", "memo", "--stdin"], b"a = 1", (0, 1)))
+
+        assert first is second
+        assert mock_run.call_count == 3
+
+    @patch("main.run_command")
+    @patch("main.CONFIG_ARGS", ())
+    def test_failed_call_is_not_cached(self, mock_run):
+        """Test that errors are raised again instead of being remembered"""
+        mock_run.side_effect = [RuntimeError("failed"), Mock()]
+
+        with pytest.raises(RuntimeError):
+            asyncio.run(run_ast_grep("run", ["--pattern", "retry"]))
+        asyncio.run(run_ast_grep("run", ["--pattern", "retry"]))
+
+        assert mock_run.call_count == 2
+
+    @patch("main.run_command")
+    def test_missing_config_is_reported_by_ast_grep(self, mock_run, mock_result, tmp_path):
+        """Test that a config file deleted after startup is passed on for ast-grep to report"""
+        config = str(tmp_path / "sgconfig.yml")
+        mock_run.return_value = mock_result
+
+        with patch.multiple("main", CONFIG_PATH=config, CONFIG_ARGS=("--config", config)):
+            result = asyncio.run(run_ast_grep("run", ["--pattern", "missing-config"]))
+
+        assert result is mock_result
+        mock_run.assert_called_once_with(["ast-grep", "run", "--config", config, "--pattern", "missing-config"], None, (0,))
+
+
+class TestSearchProject:
+    """Test the search_project function"""
+
+    def test_repeated_search_uses_cache(self, tmp_path, mock_stream_ast_grep, stream_of):
+        """Test that an unchanged project is not scanned twice"""
+        (tmp_path / "a.py").write_text("def foo(): pass\n")
+        mock_stream_ast_grep.side_effect = stream_of([{"text": "def foo(): pass"}])
+
+        first = asyncio.run(search_project("run", ["--pattern", "def $F(): pass"], str(tmp_path)))
+        second = asyncio.run(search_project("run", ["--pattern", "def $F(): pass"], str(tmp_path)))
+
+        assert first == second == ([{"text": "def foo(): pass"}], 1)
+        mock_stream_ast_grep.assert_called_once_with(
+            "run", ["--pattern", "def $F(): pass", "--json=stream", str(tmp_path)]
         )
 
+    def test_changed_project_is_rescanned(self, tmp_path, mock_stream_ast_grep, stream_of):
+        """Test that adding a file invalidates cached results"""
+        (tmp_path / "a.py").write_text("def foo(): pass\n")
+        mock_stream_ast_grep.side_effect = stream_of([])
+
+        asyncio.run(search_project("run", ["--pattern", "x"], str(tmp_path)))
+        (tmp_path / "pkg").mkdir()
+        (tmp_path / "pkg" / "b.py").write_text("x\n")
+        asyncio.run(search_project("run", ["--pattern", "x"], str(tmp_path)))
+
+        assert mock_stream_ast_grep.call_count == 2
+
+    @patch.multiple("main", CACHE_DIR=None, RESULT_CACHE_SIZE=0)
+    @patch("main.project_fingerprint")
+    def test_disabled_caches_skip_fingerprint(self, mock_fingerprint, tmp_path, mock_stream_ast_grep, stream_of):
+        """Test that the project is not fingerprinted when no cache could reuse the results"""
+        mock_stream_ast_grep.side_effect = stream_of([{"text": "x"}])
+
+        result = asyncio.run(search_project("run", ["--pattern", "x"], str(tmp_path)))
+
+        assert result == ([{"text": "x"}], 1)
+        mock_fingerprint.assert_not_called()
+
+    def test_missing_config_is_reported_by_ast_grep(self, tmp_path, mock_stream_ast_grep):
+        """Test that a config file deleted after startup does not fail the search before ast-grep runs"""
+        mock_stream_ast_grep.side_effect = RuntimeError("Cannot read configuration")
+
+        with patch("main.CONFIG_PATH", str(tmp_path / "sgconfig.yml")):
+            with pytest.raises(RuntimeError, match="Cannot read configuration"):
+                asyncio.run(search_project("run", ["--pattern", "x"], str(tmp_path)))
+
+    def test_max_results_stops_scan_early(self, mock_stream_ast_grep):
+        """Test that the scan stops after one match past max_results and the total is unknown"""
+        consumed = []
+
+        async def stream(command, args):
+            for i in range(100):
+                consumed.append(i)
+                yield json.dumps({"text": f"match{i}"}).encode() + b"\n"
+
+        mock_stream_ast_grep.side_effect = stream
+
+        matches, total = asyncio.run(search_project("run", ["--pattern", "x"], "/test/path", max_results=2))
+
+        assert matches == [{"text": "match0"}, {"text": "match1"}]
+        assert total is None
+        assert len(consumed) == 3
+
+    def test_cached_complete_results_serve_limited_search(self, tmp_path, mock_stream_ast_grep, stream_of):
+        """Test that a complete cached search answers a later limited search with the exact total"""
+        (tmp_path / "a.py").write_text("x\n")
+        mock_stream_ast_grep.side_effect = stream_of([{"text": "a"}, {"text": "b"}, {"text": "c"}])
+
+        asyncio.run(search_project("run", ["--pattern", "x"], str(tmp_path)))
+        matches, total = asyncio.run(search_project("run", ["--pattern", "x"], str(tmp_path), max_results=1))
+
+        assert matches == [{"text": "a"}]
+        assert total == 3
+        mock_stream_ast_grep.assert_called_once()
+
+    def test_cached_results_are_not_shared(self, tmp_path, mock_stream_ast_grep, stream_of):
+        """Test that each search parses its own matches from the cached lines"""
+        (tmp_path / "a.py").write_text("x\n")
+        mock_stream_ast_grep.side_effect = stream_of([{"text": "a"}])
+
+        first, _ = asyncio.run(search_project("run", ["--pattern", "x"], str(tmp_path)))
+        first[0]["text"] = "changed"
+        second, _ = asyncio.run(search_project("run", ["--pattern", "x"], str(tmp_path)))
+
+        assert second == [{"text": "a"}]
+        mock_stream_ast_grep.assert_called_once()
+
+    def test_disk_cache_survives_restart(self, tmp_path, mock_stream_ast_grep, stream_of):
+        """Test that results persisted in the cache directory are reused by a fresh process"""
+        project = tmp_path / "project"
+        project.mkdir()
+        (project / "a.py").write_text("def foo(): pass\n")
+        mock_stream_ast_grep.side_effect = stream_of([{"text": "def foo(): pass"}])
+
+        with patch("main.CACHE_DIR", str(tmp_path / "cache")):
+            first = asyncio.run(search_project("run", ["--pattern", "def $F(): pass"], str(project)))
+            main._result_cache.clear()  # simulate a server restart
+            second = asyncio.run(search_project("run", ["--pattern", "def $F(): pass"], str(project)))
+
+        assert first == second == ([{"text": "def foo(): pass"}], 1)
+        mock_stream_ast_grep.assert_called_once()
+        assert len(list((tmp_path / "cache").glob("*/*.ndjson.gz"))) == 1
+
+    def test_corrupt_disk_cache_entry_is_a_miss(self, tmp_path, mock_stream_ast_grep, stream_of):
+        """Test that a result file with a corrupt gzip body is rescanned instead of failing the search"""
+        project = tmp_path / "project"
+        project.mkdir()
+        (project / "a.py").write_text("x\n")
+        mock_stream_ast_grep.side_effect = stream_of([{"text": "x"}])
+
+        with patch("main.CACHE_DIR", str(tmp_path / "cache")):
+            asyncio.run(search_project("run", ["--pattern", "x"], str(project)))
+            [path] = (tmp_path / "cache").glob("*/*.ndjson.gz")
+            path.write_bytes(gzip.compress(b"")[:10] + b"\xff" * 20)  # valid header, garbage body
+            main._result_cache.clear()  # simulate a server restart
+            result = asyncio.run(search_project("run", ["--pattern", "x"], str(project)))
+
+        assert result == ([{"text": "x"}], 1)
+        assert mock_stream_ast_grep.call_count == 2
+
+    def test_disk_cache_ignores_results_of_other_ast_grep_version(self, tmp_path, mock_stream_ast_grep, stream_of):
+        """Test that results persisted by an older ast-grep are not reused after an upgrade"""
+        project = tmp_path / "project"
+        project.mkdir()
+        (project / "a.py").write_text("x\n")
+        mock_stream_ast_grep.side_effect = stream_of([{"text": "x"}])
+
+        with patch("main.CACHE_DIR", str(tmp_path / "cache")):
+            with patch("main.ast_grep_version", return_value="ast-grep 0.1.0"):
+                asyncio.run(search_project("run", ["--pattern", "x"], str(project)))
+            main._result_cache.clear()  # simulate a server restart
+            with patch("main.ast_grep_version", return_value="ast-grep 0.2.0"):
+                asyncio.run(search_project("run", ["--pattern", "x"], str(project)))
+
+        assert mock_stream_ast_grep.call_count == 2
+
+    @patch("main.DISK_CACHE_ENTRIES_PER_PROJECT", 1)
+    def test_disk_cache_keeps_latest_entries_per_project(self, tmp_path, mock_stream_ast_grep, stream_of):
+        """Test that storing new results deletes the oldest result files of the project"""
+        project = tmp_path / "project"
+        project.mkdir()
+        (project / "a.py").write_text("x\n")
+        mock_stream_ast_grep.side_effect = stream_of([{"text": "x"}])
+
+        with patch("main.CACHE_DIR", str(tmp_path / "cache")):
+            asyncio.run(search_project("run", ["--pattern", "x"], str(project)))
+            asyncio.run(search_project("run", ["--pattern", "y"], str(project)))
+            main._result_cache.clear()
+            asyncio.run(search_project("run", ["--pattern", "y"], str(project)))
+
+        assert len(list((tmp_path / "cache").glob("*/*.ndjson.gz"))) == 1
+        assert mock_stream_ast_grep.call_count == 2
+
+    def test_failed_disk_cache_write_leaves_no_temporary_file(self, tmp_path, mock_stream_ast_grep, stream_of):
+        """Test that a result file that cannot be renamed into place is removed again"""
+        (tmp_path / "a.py").write_text("x\n")
+        mock_stream_ast_grep.side_effect = stream_of([{"text": "x"}])
+
+        with patch("main.CACHE_DIR", str(tmp_path / "cache")), patch("main.os.replace", side_effect=OSError):
+            result = asyncio.run(search_project("run", ["--pattern", "x"], str(tmp_path)))
+
+        assert result == ([{"text": "x"}], 1)
+        assert list((tmp_path / "cache").glob("*/*")) == []
+
+    def test_disk_cache_prunes_abandoned_temporary_files(self, tmp_path, mock_stream_ast_grep, stream_of):
+        """Test that storing results deletes old temporary files of crashed writers but not recent ones"""
+        project = tmp_path / "project"
+        project.mkdir()
+        (project / "a.py").write_text("x\n")
+        mock_stream_ast_grep.side_effect = stream_of([{"text": "x"}])
+
+        with patch("main.CACHE_DIR", str(tmp_path / "cache")):
+            asyncio.run(search_project("run", ["--pattern", "x"], str(project)))
+            [project_cache] = (tmp_path / "cache").iterdir()
+            abandoned = project_cache / "old.ndjson.gz.1.tmp"
+            abandoned.write_bytes(b"")
+            os.utime(abandoned, (0, 0))
+            (project_cache / "new.ndjson.gz.2.tmp").write_bytes(b"")
+            asyncio.run(search_project("run", ["--pattern", "y"], str(project)))
+
+        assert len(list(project_cache.glob("*.ndjson.gz"))) == 2
+        assert [path.name for path in project_cache.glob("*.tmp")] == ["new.ndjson.gz.2.tmp"]
+
+    @pytest.mark.parametrize("cache_size", [32, 0], ids=["cached", "uncached"])
+    def test_concurrent_identical_searches_share_one_scan(self, tmp_path, mock_stream_ast_grep, cache_size):
+        """Test that a search started while an identical one is running waits for its results, with or without caching"""
+        (tmp_path / "a.py").write_text("x\n")
+
+        async def stream(command, args):
+            await asyncio.sleep(0.01)
+            yield json.dumps({"text": "x"}).encode() + b"\n"
+
+        mock_stream_ast_grep.side_effect = stream
+
+        async def search_twice():
+            return await asyncio.gather(
+                search_project("run", ["--pattern", "x"], str(tmp_path)),
+                search_project("run", ["--pattern", "x"], str(tmp_path)),
+            )
+
+        with patch.multiple("main", CACHE_DIR=None, RESULT_CACHE_SIZE=cache_size):
+            first, second = asyncio.run(search_twice())
+
+        assert first == second == ([{"text": "x"}], 1)
+        mock_stream_ast_grep.assert_called_once()
+        assert main._inflight_scans == {}
+        assert len(main._result_cache) == (cache_size > 0)
+
+    def test_shared_scan_failure_reaches_every_caller(self, tmp_path, mock_stream_ast_grep):
+        """Test that an error of the shared scan is raised for each waiting search"""
+        (tmp_path / "a.py").write_text("x\n")
+
+        async def stream(command, args):
+            await asyncio.sleep(0.01)
+            raise RuntimeError("ast-grep failed")
+            yield
+
+        mock_stream_ast_grep.side_effect = stream
+
+        async def search_twice():
+            return await asyncio.gather(
+                search_project("run", ["--pattern", "y"], str(tmp_path)),
+                search_project("run", ["--pattern", "y"], str(tmp_path)),
+                return_exceptions=True,
+            )
+
+        results = asyncio.run(search_twice())
+
+        assert [str(result) for result in results] == ["ast-grep failed", "ast-grep failed"]
+        mock_stream_ast_grep.assert_called_once()
+
+    @pytest.mark.parametrize(
+        "project,ignore_file",
+        [("", ".gitignore"), ("", "sub/.ignore"), ("", ".git/info/exclude"), ("project", ".gitignore")],
+        ids=["root", "nested", "exclude", "parent"],
+    )
+    def test_fingerprint_detects_ignore_file_edits(self, tmp_path, project, ignore_file):
+        """Test that editing an ignore file in place changes the fingerprint, since it changes what ast-grep scans"""
+        for path in (".git/info/exclude", ".gitignore", "sub/.ignore", "project/a.py"):
+            (tmp_path / path).parent.mkdir(parents=True, exist_ok=True)
+            (tmp_path / path).write_text("gen/\n")
+        before = project_fingerprint(str(tmp_path / project))
+        (tmp_path / ignore_file).write_text("!gen/\n")
+
+        assert project_fingerprint(str(tmp_path / project)) != before
+
+    def test_fingerprint_skips_ignored_folders(self, tmp_path):
+        """Test that a gitignored subtree neither affects the fingerprint nor gets walked"""
+        (tmp_path / ".git").mkdir()
+        (tmp_path / ".gitignore").write_text("node_modules/\n")
+        (tmp_path / "a.py").write_text("x\n")
+        (tmp_path / "node_modules" / "pkg").mkdir(parents=True)
+        before = project_fingerprint(str(tmp_path))
+        (tmp_path / "node_modules" / "pkg" / "index.js").write_text("x\n")
+
+        with patch("main.os.scandir", wraps=os.scandir) as scandir:
+            assert project_fingerprint(str(tmp_path)) == before
+
+        assert [call.args[0] for call in scandir.call_args_list] == [str(tmp_path)]
+
+    # Checked against ast-grep: each case tells whether it scans the given folder of the project
+    @pytest.mark.parametrize(
+        "files,project,folder,walked",
+        [
+            ({".ignore": "lib\n"}, "", "sub/lib", False),
+            ({".gitignore": "lib\n"}, "", "sub/lib", True),
+            ({".git/HEAD": "", ".gitignore": "sub/*/\n"}, "", "sub/lib", False),
+            ({".git/HEAD": "", ".gitignore": "**/lib\n"}, "", "sub/lib", False),
+            ({".git/HEAD": "", ".gitignore": "/lib/\n"}, "", "sub/lib", True),
+            ({".git/HEAD": "", ".gitignore": "lib/\n!sub/lib/\n"}, "", "sub/lib", True),
+            ({".git/HEAD": "", ".gitignore": "lib/\n", "sub/.ignore": "!lib/\n"}, "", "sub/lib", True),
+            ({".git/HEAD": "", ".ignore": "!lib/\n", "sub/.gitignore": "lib/\n"}, "", "sub/lib", True),
+            ({".git/HEAD": "", ".gitignore": "!lib/\n", "sub/.gitignore": "lib/\n"}, "", "sub/lib", False),
+            ({".git/HEAD": "", ".git/info/exclude": "lib/\n", ".gitignore": "!lib/\n"}, "", "sub/lib", True),
+            ({".git/HEAD": "", ".git/info/exclude": "lib/\n"}, "project", "sub/lib", False),
+            ({".git/HEAD": "", ".gitignore": "lib/\n", "sub/.git/HEAD": ""}, "", "sub/lib", True),
+            ({".ignore": "/project/sub/\n"}, "project", "sub/lib", False),
+            ({".ignore": "/sub/\n"}, "project", "sub/lib", True),
+            ({".ignore": "!lib/\n", "project/.git/HEAD": "", "project/.gitignore": "lib/\n"}, "project", "lib", True),
+            ({".git/HEAD": ""}, "", ".github", False),
+            ({".git/HEAD": "", ".gitignore": "!.github/\n"}, "", ".github", True),
+        ],
+        ids=["ignore", "gitignore-outside-repo", "wildcard", "globstar", "anchored", "negated", "nested-negated",
+             "ignore-outranks-deeper-gitignore", "deeper-gitignore-wins", "gitignore-outranks-exclude", "exclude",
+             "nested-repo", "parent", "parent-anchored", "ignore-above-repo", "hidden", "negated-hidden"],
+    )
+    def test_fingerprint_follows_ignore_rules(self, tmp_path, files, project, folder, walked):
+        """Test that exactly the folders ast-grep skips are left out of the walk"""
+        for path, text in files.items():
+            (tmp_path / path).parent.mkdir(parents=True, exist_ok=True)
+            (tmp_path / path).write_text(text)
+        folder = tmp_path / project / folder
+        folder.mkdir(parents=True)
+
+        with patch("main.os.scandir", wraps=os.scandir) as scandir:
+            project_fingerprint(str(tmp_path / project))
+
+        assert (str(folder) in [call.args[0] for call in scandir.call_args_list]) == walked
+
+    def test_fingerprint_ignores_hidden_entries(self, tmp_path):
+        """Test that hidden folders do not affect the fingerprint"""
+        (tmp_path / "a.py").write_text("x\n")
+        before = project_fingerprint(str(tmp_path))
+        mtime = os.stat(tmp_path).st_mtime_ns
+        (tmp_path / ".cache").mkdir()
+        (tmp_path / ".cache" / "data").write_text("x\n")
+        os.utime(tmp_path, ns=(mtime, mtime))
+
+        assert project_fingerprint(str(tmp_path)) == before
+
+    def test_fingerprint_detects_restored_mtime(self, tmp_path):
+        """Test that an edit is detected even if the file gets its old mtime back"""
+        source = tmp_path / "a.py"
+        source.write_text("x\n")
+        mtime = os.stat(source).st_mtime_ns
+        before = project_fingerprint(str(tmp_path))
+        source.write_text("x = 1\n")
+        os.utime(source, ns=(mtime, mtime))
+
+        assert project_fingerprint(str(tmp_path)) != before
+
+    def test_fingerprint_missing_folder(self):
+        """Test that a missing folder has no fingerprint"""
+        assert project_fingerprint("/nonexistent/path/xyz") is None
+
+
+class TestParseArgsAndGetConfig:
+    """Test the parse_args_and_get_config function"""
+
+    @patch.multiple("main", CONFIG_PATH=None, CONFIG_ARGS=(), CACHE_DIR=None, RESULT_CACHE_SIZE=32)
+    def test_config_from_environment(self, tmp_path):
+        """Test that AST_GREP_CONFIG is used when --config is not given"""
+        config = tmp_path / "sgconfig.yml"
+        config.write_text("ruleDirs: []\n")
+
+        with patch("sys.argv", ["main.py"]), patch.dict(os.environ, {"AST_GREP_CONFIG": str(config)}):
+            parse_args_and_get_config()
+
+        assert main.CONFIG_ARGS == ("--config", str(config))
+
+    @patch.multiple("main", CONFIG_PATH=None, CONFIG_ARGS=(), CACHE_DIR=None, RESULT_CACHE_SIZE=32)
+    def test_config_directory_is_rejected(self, tmp_path, capsys):
+        """Test that a directory is not accepted as config file and the error goes to stderr"""
+        with patch("sys.argv", ["main.py", "--config", str(tmp_path)]):
+            with pytest.raises(SystemExit, match="is not a file"):
+                parse_args_and_get_config()
+
+        assert capsys.readouterr().out == ""
+
 
 if __name__ == "__main__":
     pytest.main([__file__, "-v"])